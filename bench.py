@@ -0,0 +1,191 @@
+"""
+Benchmarks, run with
+
+    python bench.py [name ...]
+
+with no names every benchmark is run.
+"""
+import sys
+import time
+
+import numpy as np
+
+from classes import *
+from tests import atts1, atts3
+
+
+def timed(f, *args, **kwargs):
+    """ calls f, returns its result and the seconds it took """
+    start = time.perf_counter()
+    result = f(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_jit(n: float = 1e7):
+    """ numba kernel against the numpy path, big pools use n / 10 rolls """
+    from jit import HAVE_NUMBA, jit_dist
+
+    if not HAVE_NUMBA:
+        print("jit: numba is not installed, skipping")
+        return
+
+    big_pool = RollDef(50 * D(10), Sum(Highest(10)), name="50d10, 10 highest")
+    for rd, rd_n in [(atts1, n), (atts3, n), (big_pool, n / 10)]:
+        jit_dist(rd, 1e3, seed=0)  # compile outside the timing
+
+        numpy_d, numpy_s = timed(Dist.calc, rd, rd_n)
+        jit_d, jit_s = timed(jit_dist, rd, rd_n, seed=0)
+        again, _ = timed(jit_dist, rd, rd_n, seed=0)
+
+        print(f"jit: {rd.name:<20} numpy {numpy_s:7.2f}s  numba {jit_s:7.2f}s  "
+              f"x{numpy_s / jit_s:5.1f}  mean {numpy_d.mean:.4f} / {jit_d.mean:.4f}  "
+              f"reproducible {np.array_equal(jit_d.values, again.values)}")
+
+
+def bench_service(queries: int = 20000, clients: int = 8):
+    """ statistic queries per second against a cached Dist """
+    import asyncio
+    from service import DistService, Client
+
+    async def run():
+        service = DistService(workers=1)
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        connected = [await Client.connect(port=port) for _ in range(clients)]
+        key = (await connected[0].dist(atts3, n=1e5))["key"]
+
+        async def ask(c, k):
+            for i in range(k):
+                await c.stat(key, "at_least", 3 + i % 16)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[ask(c, queries // clients) for c in connected])
+        seconds = time.perf_counter() - start
+
+        for c in connected:
+            await c.close()
+        server.close()
+        service.close()
+        print(f"service: {queries} stat queries from {clients} clients in {seconds:.2f}s "
+              f"({queries / seconds:,.0f} queries/s)")
+
+    asyncio.run(run())
+
+
+def bench_dashboard(sizes=(10, 50, 200)):
+    """ dashboard build and save time against the number of definitions """
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
+    from viz import RollDefDashboard, render_dashboards
+    from exact import exact_dist
+    import tempfile
+    from pathlib import Path
+
+    sweep = [exact_dist(RollDef(RollDef(4 * D(6), Sum(Highest(3))), ReRoll(LessThan(3 + i % 16)),
+                                name=f"sweep {i}")) for i in range(max(sizes))]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            for batched in [False, True]:
+                start = time.perf_counter()
+                RollDefDashboard(sweep[:size], batched=batched).save(Path(tmp) / "d.png")
+                seconds = time.perf_counter() - start
+                print(f"dashboard: {size:4d} definitions, batched {batched!s:<5}  {seconds:6.2f}s")
+
+        dashboards = [RollDefDashboard(sweep[:50]) for _ in range(4)]
+        plt.close("all")
+        paths = [Path(tmp) / f"d{i}.png" for i in range(4)]
+        _, seconds = timed(render_dashboards, dashboards, paths)
+        print(f"dashboard: 4 dashboards of 50 definitions rendered by a process pool in {seconds:.2f}s")
+
+
+def bench_threads(n: float = 4e6, threads=(1, 2, 4, 8)):
+    """ in process thread pool scaling against the thread count """
+    import os
+    from threaded import threaded_dist
+
+    _, single = timed(Dist.calc, atts1, n)
+    print(f"threads: {os.cpu_count()} cpus, single threaded Dist.calc {single:.2f}s")
+    for t in threads:
+        d, seconds = timed(threaded_dist, atts1, n, threads=t, seed=0)
+        print(f"threads: {t:2d} threads {seconds:6.2f}s  x{single / seconds:4.1f}  mean {d.mean:.4f}")
+
+
+def bench_workspace(chunk: int = 2 ** 16, calls: int = 200):
+    """ repeated chunks of a rolldef, bound to a Workspace against allocating """
+    import tracemalloc
+
+    for bound in [False, True]:
+        atts1.bind(Workspace(chunk) if bound else None)
+        atts1(chunk)
+
+        tracemalloc.start()
+        atts1(chunk)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        _, seconds = timed(lambda: [atts1(chunk) for _ in range(calls)])
+        print(f"workspace: bound {bound!s:<5} {calls} chunks of {chunk} in {seconds:5.2f}s  "
+              f"peak allocation per chunk {peak / 1024:8.1f} KiB")
+    atts1.bind(None)
+
+
+def bench_solver(n: float = 1e5):
+    """ backward induction against simulating a sweep of reroll thresholds """
+    from solver import optimal_rerolls, optimal_budget
+    from tests import atts2
+
+    def sweep():
+        dists = [Dist.calc(RollDef(atts2, ReRoll(LessThan(i))), n) for i in range(9, 17)]
+        return max(dists, key=lambda d: d.mean)
+
+    best, sweep_s = timed(sweep)
+    policy, solve_s = timed(optimal_rerolls, atts2, 1)
+    print(f"solver: sweep of 8 thresholds {sweep_s:6.2f}s, best {best.rolldef.ops[0].selector.less_than} "
+          f"mean {best.mean:.4f}")
+    print(f"solver: backward induction {solve_s * 1e3:6.2f}ms, best "
+          f"{policy.rolldef.ops[0].selector.less_than} mean {policy.value:.4f}")
+
+    budget, seconds = timed(optimal_budget, atts2, 6, 6)
+    print(f"solver: 6 stats sharing 6 rerolls {seconds * 1e3:6.2f}ms, expected total {budget.value:.3f}")
+
+
+def bench_serializer(n: float = 1e4, loads: int = 20):
+    """ dump size and load time of the reroll strategy dashboard in both formats """
+    import matplotlib
+    matplotlib.use("Agg")
+    from serializer import Serializer
+    from viz import RollDefDashboard
+
+    rolldefs = [RollDef(RollDef(4 * RollDef(D(6), ReRoll(EqualTo(1))), Sum(Highest(3))),
+                        ReRoll(LessThan(i)), name=f"RR LT {i}") for i in range(9, 17)]
+    dashboard = RollDefDashboard.from_rolldefs(rolldefs, n=n)
+
+    def load(dumped):
+        for _ in range(loads):
+            s.load(dumped)
+
+    s = Serializer()
+    for fmt in [1, 2]:
+        dumped, dump_s = timed(s.dump, dashboard, format=fmt)
+        _, load_s = timed(load, dumped)
+        print(f"serializer: format {fmt}  {len(dumped) / 1024:7.1f} KiB  dump {dump_s * 1e3:6.2f}ms  "
+              f"load {load_s / loads * 1e3:6.2f}ms")
+
+
+BENCHMARKS = {
+    "jit": bench_jit,
+    "service": bench_service,
+    "dashboard": bench_dashboard,
+    "threads": bench_threads,
+    "workspace": bench_workspace,
+    "solver": bench_solver,
+    "serializer": bench_serializer,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
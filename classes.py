@@ -1,6 +1,7 @@
 from typing import Union, List, Tuple
 import numpy as np
-from util import dist, combine_dists, median_from_dist, mean_from_dist
+from util import dist, combine_dists, median_from_dist, mean_from_dist, percentile_from_dist, \
+    generator, bound_generator, bound_workspace, bind_workspace
 
 
 # Die =====================================================
@@ -38,6 +39,9 @@ class Die(Source):
             self._n_sides = sides
             self._mapper = None
 
+        # face values by zero based index, for mapping rolls without a python loop
+        self._face_array = np.array(self._faces, dtype=np.int64)
+
     def __rmul__(self, other: int):
         """ defines leading integer multiplicative behavior of die """
         assert isinstance(other, int)
@@ -50,21 +54,39 @@ class Die(Source):
         else:
             return f"(D[{self._faces}]"
 
-    def __call__(self, n: Union[int, float] = None):
+    def __call__(self, n: Union[int, float] = None, out: np.array = None, scratch: np.array = None):
+        """
+        rolls the die n times, into 'out' if given. With a float64 'scratch'
+        array of length n, and a generator bound, nothing is allocated.
+        """
         if n is None:
             n = 1
 
-        # the result is a random side
-        result = np.random.randint(1, self._n_sides + 1, int(n))
+        # the result is a random side, from this thread's generator if one is bound
+        gen = generator()
+        if out is not None and scratch is not None and gen is not None:
+            # uniform floats are truncated to a zero based face index
+            gen.random(out=scratch)
+            np.multiply(scratch, self._n_sides, out=out, casting="unsafe")
+            if self._mapper is None:
+                return np.add(out, 1, out=out)
+            return np.take(self._face_array, out, out=out, mode="clip")
+
+        if gen is None:
+            result = np.random.randint(1, self._n_sides + 1, int(n))
+        else:
+            result = gen.integers(1, self._n_sides + 1, int(n))
 
         # map the result to the actual sides if needed
         if self._mapper is not None:
-            print(self._mapper)
-            result = np.vectorize(self._mapper.get)(result)
+            result = self._face_array[result - 1]
 
         if n == 1:
             result.reshape(1, 1)
 
+        if out is not None:
+            np.copyto(out, result)
+            return out
         return result
 
 
@@ -73,16 +95,36 @@ class D(Die):
     pass
 
 
+def _call(op, *args, **buffers):
+    """
+    calls an op with only the buffers that are given, so ops written without
+    'out' or 'scratch' arguments still work when no workspace is bound
+    """
+    return op(*args, **{k: v for k, v in buffers.items() if v is not None})
+
+
 # Filters =================================================
-class Filter(object):
+def _sorted(arr: np.array, out: np.array = None) -> np.array:
+    """ arr sorted along its last axis, in 'out' if given """
+    if out is None:
+        return np.sort(arr)
+    np.copyto(out, arr)
+    out.sort()
+    return out
+
 
-    def __call__(self, arr: np.array):
+class Filter(object):
+    """
+    Filters take an optional 'out' array shaped like their input, which
+    they may use in place of allocating, and return a view of it.
+    """
+    def __call__(self, arr: np.array, out: np.array = None):
         pass
 
 
 class All(Filter):
 
-    def __call__(self, arr: np.array):
+    def __call__(self, arr: np.array, out: np.array = None):
         return arr
 
 
@@ -100,7 +142,7 @@ class Position(Filter):
         else:
             self.slice = args[0]
 
-    def __call__(self, arr: np.array):
+    def __call__(self, arr: np.array, out: np.array = None):
         result = arr[:, self.slice]
         if self._ndims == 1:
             return result.reshape(-1, 1)
@@ -114,8 +156,8 @@ class Highest(Filter):
 
         self.n = n
 
-    def __call__(self, arr: np.array):
-        rolls = np.sort(arr)
+    def __call__(self, arr: np.array, out: np.array = None):
+        rolls = _sorted(arr, out)
         return rolls[:, -self.n:]
 
 
@@ -124,8 +166,8 @@ class Lowest(Filter):
     def __init__(self, n: int = None):
         self.n = n
 
-    def __call__(self, arr: np.array):
-        result = np.sort(arr)
+    def __call__(self, arr: np.array, out: np.array = None):
+        result = _sorted(arr, out)
         return result[:, :self.n]
 
 
@@ -133,9 +175,10 @@ class Lowest(Filter):
 class Selector(object):
     """
     Selectors do not produce an output of a predictable dimension,
-    and thus really only work for 1d -> 1d
+    and thus really only work for 1d -> 1d. The boolean selection is
+    written into 'out' when it is given.
     """
-    def __call__(self, arr: np.array):
+    def __call__(self, arr: np.array, out: np.array = None):
         return arr
 
 
@@ -144,8 +187,14 @@ class EqualTo(Selector):
     def __init__(self, values: Union[int, List[int]]):
         self.values = values
 
-    def __call__(self, arr: np.array):
+    def __call__(self, arr: np.array, out: np.array = None):
+        if out is not None and np.ndim(self.values) == 0:
+            return np.equal(arr, self.values, out=out)
+
         result = np.isin(arr, self.values)
+        if out is not None:
+            np.copyto(out, result)
+            return out
         return result
 
 
@@ -154,8 +203,8 @@ class LessThan(Selector):
     def __init__(self, less_than: int):
         self.less_than = less_than
 
-    def __call__(self, arr: np.array):
-        return arr < self.less_than
+    def __call__(self, arr: np.array, out: np.array = None):
+        return np.less(arr, self.less_than, out=out)
 
 
 class GreaterThan(Selector):
@@ -163,8 +212,8 @@ class GreaterThan(Selector):
     def __init__(self, greater_than: int):
         self.greater_than = greater_than
 
-    def __call__(self, arr: np.array):
-        return arr > self.greater_than
+    def __call__(self, arr: np.array, out: np.array = None):
+        return np.greater(arr, self.greater_than, out=out)
 
 
 # Aggregator  =============================================
@@ -212,40 +261,47 @@ class Aggregator(object):
                 return True
         return False
 
-    def _op(self, arr: np.array):
+    def _op(self, arr: np.array, scratch: List[np.array] = None):
+        """ applies the ops, each may use its own 'out' array from scratch """
+        if scratch is None:
+            scratch = [None] * len(self.ops)
 
         if self._single_selector():
-            selection = self.ops[0](arr)
+            selection = _call(self.ops[0], arr, out=scratch[0])
             return arr[selection]
 
         elif self._dual_selector():
-            return [arr[o(arr)] for o in self.ops]
+            return [arr[_call(o, arr, out=s)] for o, s in zip(self.ops, scratch)]
 
         elif self._single_filter():
-            return self.ops[0](arr)
+            return _call(self.ops[0], arr, out=scratch[0])
 
         elif self._dual_filter():
-            return [o(arr) for o in self.ops]
+            return [_call(o, arr, out=s) for o, s in zip(self.ops, scratch)]
 
         else:
             return arr
 
-    def __call__(self, arr: np.array):
+    def __call__(self, arr: np.array, out: np.array = None, scratch: List[np.array] = None):
+        """
+        aggregates each roll, into 'out' if given. 'scratch' holds an array
+        shaped like arr for each op, boolean for selectors.
+        """
         pass
 
 
 class Sum(Aggregator):
 
-    def __call__(self, arr: np.array):
+    def __call__(self, arr: np.array, out: np.array = None, scratch: List[np.array] = None):
 
-        result = self._op(arr)
+        result = self._op(arr, scratch)
         if self._dual_filter():
             result = np.hstack((result[0], result[1]))
         elif self._dual_selector():
             result = np.sum(result)
 
         if len(result.shape) > 1:
-            return np.sum(result, axis=1)
+            return np.sum(result, axis=1, out=out)
         else:
             print("TODO: is this a desireable case for Sum?")
             return arr
@@ -258,18 +314,57 @@ class Difference(Aggregator):
 
         assert self._dual_selector() or self._dual_filter()
 
-    def __call__(self, arr: np.array):
+    def __call__(self, arr: np.array, out: np.array = None, scratch: List[np.array] = None):
 
-        result = self._op(arr)
+        result = self._op(arr, scratch)
         first = result[0]
         second = result[1]
+        if out is not None and out.size == first.size:
+            return np.subtract(first, second, out=out.reshape(first.shape))
         return first - second
 
 
+class Count(Aggregator):
+    """ counts the dice in each roll that match one or more selectors """
+
+    def __init__(self, ops: Union[Selector, List[Selector]]):
+        super().__init__(ops)
+
+        assert all([isinstance(o, Selector) for o in self.ops])
+
+    def select(self, arr: np.array, scratch: List[np.array] = None):
+        """ boolean array of dice matching any of the selectors """
+        if scratch is None:
+            scratch = [None] * len(self.ops)
+        scratch = [s if s is None else s.reshape(arr.shape) for s in scratch]
+
+        selection = _call(self.ops[0], arr, out=scratch[0])
+        for o, s in zip(self.ops[1:], scratch[1:]):
+            selection |= _call(o, arr, out=s)
+        return selection
+
+    def __call__(self, arr: np.array, out: np.array = None, scratch: List[np.array] = None):
+
+        if len(arr.shape) == 1:
+            arr = arr.reshape(-1, 1)
+
+        selection = self.select(arr, scratch)
+        if out is None:
+            # count_nonzero sums the booleans directly, no int64 copy of the selection
+            return np.count_nonzero(selection, axis=1)
+
+        # adding column by column casts the booleans in small buffers
+        np.copyto(out, selection[:, 0])
+        for j in range(1, selection.shape[1]):
+            np.add(out, selection[:, j], out=out)
+        return out
+
+
 # Conditional Actions =====================================
 class Action(object):
 
-    def __call__(self, arr: np.array, source: Die):
+    def __call__(self, arr: np.array, source: Die, scratch: List[np.array] = None):
+        """ acts on arr in place, may use the arrays in scratch instead of allocating """
         pass
 
 
@@ -278,26 +373,40 @@ class ReRoll(Action):
     def __init__(self, selector: Union[Selector, List[Selector]]):
         self.selector = selector
 
-    def select(self, arr: np.array):
+    def select(self, arr: np.array, out: np.array = None):
 
         if isinstance(self.selector, list):
-            selections = [s(arr) for s in self.selector]
-            selection = np.sum(selections)
+            if out is None:
+                selections = [s(arr) for s in self.selector]
+                selection = np.any(selections, axis=0)
+            else:
+                selection = _call(self.selector[0], arr, out=out)
+                for s in self.selector[1:]:
+                    selection |= s(arr)
 
         elif isinstance(self.selector, Selector):
-            selection = self.selector(arr)
+            selection = _call(self.selector, arr, out=out)
 
         else:
             raise Exception("what?")
 
         return selection
 
-    def __call__(self, arr: np.array, source: Die):
-        selected = self.select(arr)
+    def __call__(self, arr: np.array, source: Die, scratch: List[np.array] = None):
+        """
+        scratch holds a boolean mask, a rerolls array and a float64 array
+        for drawing them, all shaped like arr
+        """
+        mask, drawn, uniform = (None, None, None) if scratch is None else scratch
+        selected = self.select(arr, out=mask)
 
-        n_rerolls = sum(selected)
+        n_rerolls = np.count_nonzero(selected)
         if n_rerolls > 0:
-            rerolls = source(n_rerolls)
+            if drawn is not None and isinstance(source, Die):
+                rerolls = source(n_rerolls, out=drawn.reshape(-1)[:n_rerolls],
+                                 scratch=uniform.reshape(-1)[:n_rerolls])
+            else:
+                rerolls = source(n_rerolls)
             arr[selected] = rerolls
         return arr
 
@@ -335,7 +444,29 @@ class RollDef(RollDef_):
         assert isinstance(other, int)
         return [RollDef(self.source, self.ops) for _ in range(other)]
 
+    def bind(self, workspace):
+        """
+        Binds this rolldef and the rolldefs in its source to a Workspace, so
+        calls reuse its buffers instead of allocating, None unbinds. The rolls
+        returned by a bound rolldef are overwritten by its next call. The
+        binding only holds in the calling thread, other threads, such as those
+        of threaded_dist, roll the rolldef unbound.
+        """
+        bind_workspace(self, workspace)
+        for s in (self.source if isinstance(self.source, list) else [self.source]):
+            if isinstance(s, RollDef):
+                s.bind(workspace)
+        return self
+
+    @property
+    def _workspace(self):
+        """ the Workspace bound to this rolldef in the current thread """
+        return bound_workspace(self)
+
     def _sources(self, n: int = None):
+        if self._workspace is not None:
+            return self._bound_sources(int(n))
+
         if isinstance(self.source, list):
             rolls = [s(n) for s in self.source]
             stack = np.column_stack(rolls)
@@ -343,33 +474,83 @@ class RollDef(RollDef_):
         else:
             return self.source(n)
 
+    def _bound_sources(self, n: int):
+        """
+        draws the sources into this rolldef's own workspace buffer. Results of
+        source rolldefs are copied out straight away, as a source used twice
+        (or rolled again by a ReRoll) overwrites its buffers.
+        """
+        ws = self._workspace
+        if not isinstance(self.source, list):
+            if isinstance(self.source, Die):
+                return self.source(n, out=ws.buffer((self, "source"), (n,), np.int64),
+                                   scratch=ws.buffer((self, "uniform"), (n,), np.float64))
+            rolls = self.source(n)
+            result = ws.buffer((self, "source"), rolls.shape, rolls.dtype)
+            np.copyto(result, rolls)
+            return result
+
+        result = ws.buffer((self, "source"), (n, len(self.source)), np.int64)
+        column = ws.buffer((self, "column"), (n,), np.int64)
+        uniform = ws.buffer((self, "uniform"), (n,), np.float64)
+        for j, s in enumerate(self.source):
+            rolls = s(n, out=column, scratch=uniform) if isinstance(s, Die) else s(n)
+            if rolls.shape != column.shape:
+                # sources of several columns are stacked as when unbound, copying bound rolls out
+                rest = [np.asarray(s(n)).reshape(n, -1).copy() for s in self.source[j + 1:]]
+                return np.column_stack([result[:, :j], rolls.reshape(n, -1).copy()] + rest)
+            result[:, j] = rolls
+        return result
+
     def __call__(self, n: int = None):
 
         if n is None:
             n = 1
 
+        if self._workspace is not None and generator() is None:
+            with bound_generator(self._workspace.generator):
+                return self(n)
+
         # initialize by calling first arg, which should be a source!
         result = self._sources(n)
 
         if self.verbose:
             print("source", result, result.shape)
 
-        for op in self.ops:
+        return self._apply(result)
+
+    def _apply(self, result: np.array):
+        """ runs the ops of this rolldef over rolls already drawn from its source """
+        ws = self._workspace
+        for i, op in enumerate(self.ops):
 
             if isinstance(op, Action):
-                result = op(result, self.source)
+                scratch = None
+                if ws is not None:
+                    scratch = [ws.buffer((self, i, "mask"), result.shape, np.bool_),
+                               ws.buffer((self, i, "rerolls"), result.shape, result.dtype),
+                               ws.buffer((self, i, "uniform"), result.shape, np.float64)]
+                result = _call(op, result, self.source, scratch=scratch)
 
                 if self.verbose:
                     print(op, '\n', result, result.shape)
 
             elif isinstance(op, Aggregator):
-                result = op(result)
+                if ws is None:
+                    result = op(result)
+                else:
+                    scratch = [ws.buffer((self, i, j), result.shape,
+                                         np.bool_ if isinstance(o, Selector) else result.dtype)
+                               for j, o in enumerate(op.ops)]
+                    out = ws.buffer((self, i, "out"), result.shape[:1], result.dtype)
+                    result = op(result, out=out, scratch=scratch)
 
                 if self.verbose:
                     print(op, '\n', result, result.shape)
 
             elif isinstance(op, Filter):
-                result = op(result)
+                out = None if ws is None else ws.buffer((self, i, "out"), result.shape, result.dtype)
+                result = _call(op, result, out=out)
 
                 if self.verbose:
                     print(op, '\n', result, result.shape)
@@ -381,6 +562,43 @@ class RollDef(RollDef_):
         return Dist.calc(rolldef=self, n=n)
 
 
+# Workspace ===============================================
+class Workspace(object):
+    """
+    Reusable buffers for rolldefs bound to it with RollDef.bind. Each op of a
+    bound rolldef writes into its own buffers, allocated on first use for
+    up to 'chunk' rolls and reused by every later call of that size or less.
+    Rolls are drawn from this workspace's generator unless one is bound to
+    the thread. Bindings are per thread, so a workspace is only ever used by
+    the thread that bound it.
+    """
+
+    def __init__(self, chunk: Union[int, float], seed: int = None):
+        self.chunk = int(chunk)
+        self.seed = seed
+
+        self.generator = np.random.default_rng(seed)
+        self._buffers = {}
+
+    def buffer(self, key: Tuple, shape: Tuple, dtype) -> np.array:
+        """ the buffer of an owner object and role, as an array of shape and dtype """
+        owner, role = key[0], key[1:]
+        size = int(np.prod(shape))
+        held = self._buffers.get((id(owner),) + role)
+        if held is None or held[1].dtype != dtype or held[1].size < size:
+            rows = max(shape[0], self.chunk) if shape else 1
+            buf = np.empty(rows * int(np.prod(shape[1:])), dtype=dtype)
+            # the owner is held so its id is not reused by another object
+            held = (owner, buf)
+            self._buffers[(id(owner),) + role] = held
+        return held[1][:size].reshape(shape)
+
+    @property
+    def nbytes(self) -> int:
+        """ total size of the buffers held """
+        return sum([buf.nbytes for _, buf in self._buffers.values()])
+
+
 # Result storage and viz ==================================
 class Dist(object):
 
@@ -390,7 +608,12 @@ class Dist(object):
                  rolldef: RollDef,
                  mean: float = None,
                  median: float = None,
-                 n: int = None):
+                 n: int = None,
+                 exact: bool = False,
+                 weights: np.array = None,
+                 weights_sq: np.array = None,
+                 ess: float = None,
+                 sampler=None):
         """
         Stores the values of a rolldef distribution calculation.
 
@@ -398,6 +621,11 @@ class Dist(object):
         :param bins:
         :param rolldef:
         :param n:
+        :param exact: True if the values are exact probabilities, not sampled
+        :param weights: per bin sums of the likelihood ratio weights of weighted samples
+        :param weights_sq: per bin sums of the squared weights
+        :param ess: effective sample size of weighted samples
+        :param sampler: the sampling.Sampler that drew weighted samples
         """
 
         self.values = values
@@ -406,6 +634,11 @@ class Dist(object):
         self.mean = mean
         self.median = median
         self.n = n
+        self.exact = exact
+        self.weights = weights
+        self.weights_sq = weights_sq
+        self.ess = ess
+        self.sampler = sampler
 
     def __call__(self, n: int = None):
         """ relay underlying rolldef calls """
@@ -415,7 +648,23 @@ class Dist(object):
         """
         Add additional simulations of the rolldef, updates
         the 'values', 'bins', and 'n', attributes of this class instance.
+        Exact distributions are returned unchanged.
         """
+        if self.exact:
+            return self.values, self.bins
+
+        if self.sampler is not None:
+            combined = self.sampler.combine(self, self.sampler.dist(self.rolldef, n))
+            self.values = combined.values
+            self.bins = combined.bins
+            self.n = combined.n
+            self.mean = combined.mean
+            self.median = combined.median
+            self.weights = combined.weights
+            self.weights_sq = combined.weights_sq
+            self.ess = combined.ess
+            return self.values, self.bins
+
         added_rolls = self.rolldef(n)
         added_vals, added_bins = dist(added_rolls)
         new_values, new_bins = \
@@ -429,12 +678,40 @@ class Dist(object):
         self.n = self.n + n
         return self.values, self.bins
 
+    def percentile(self, q: float):
+        """ the q-th percentile (0 to 100) of the distribution """
+        return percentile_from_dist(self.values, self.bins, q)
+
+    def prob_at_least(self, k: int) -> float:
+        """ probability of a result greater than or equal to k """
+        return float(np.sum(self.values[self.bins[:-1] >= k]))
+
+    def counts(self) -> Tuple[np.array, np.array]:
+        """ recovers the integer counts behind the sampled values """
+        return np.rint(self.values * self.n).astype(np.int64), self.bins
+
+    @classmethod
+    def from_counts(cls, counts: np.array, bins: np.array, rolldef: RollDef):
+        """ instantiates from an integer count histogram of sampled rolls """
+        n = int(np.sum(counts))
+        values = counts / n
+        return cls(values=values, bins=bins, rolldef=rolldef,
+                   mean=mean_from_dist(values, bins),
+                   median=median_from_dist(values, bins), n=n)
+
     @classmethod
-    def calc(cls, rolldef: RollDef, n: Union[int, float] = None):
-        """ instantiates from a rolldef and a number of times to roll for histogram """
+    def calc(cls, rolldef: RollDef, n: Union[int, float] = None, sampler=None):
+        """
+        instantiates from a rolldef and a number of times to roll for histogram.
+        A sampling.Sampler may be given to draw weighted samples instead.
+        threaded.threaded_dist rolls on a pool of threads.
+        """
         if n is None:
             n = 1e6
 
+        if sampler is not None:
+            return sampler.dist(rolldef, n)
+
         rolls = rolldef(n)
         values, bins = dist(rolls)
         return cls(values=values, bins=bins, rolldef=rolldef,
@@ -0,0 +1,295 @@
+"""
+Batch runner for libraries of serialized roll definitions.
+
+    python -m distat defs/ --n 1e7 --workers 8 --seed 1 --out results/
+
+Every json file given (or found in a given directory) is loaded with the
+Serializer. RollDefs are turned into Dists, and Dists, including those in
+dashboards, are topped up until they hold 'n' samples. Results are written
+to the output path under the same file name. If a result file already
+exists it is loaded instead of the definition, so interrupted runs resume
+and finished runs can be topped up with a larger 'n'.
+"""
+import argparse
+import time
+from multiprocessing import Pool
+from pathlib import Path
+from typing import List, Union
+
+import numpy as np
+
+from classes import Die, RollDef, Dist
+from serializer import Serializer
+from util import counts, combine_counts, accumulate_counts, bound_generator
+from viz import RollDefDashboard
+
+
+# bytes of working memory used per die per simulated roll, allows for the
+# int64 rolls themselves plus the sort, selection and reroll temporaries
+BYTES_PER_DIE = 8 * 4
+
+UNITS = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30}
+
+
+def parse_bytes(s: str) -> int:
+    """ parses a memory size such as '512M' or '2G' into bytes """
+    s = s.strip().upper().rstrip("B")
+    if s and s[-1] in UNITS:
+        return int(float(s[:-1]) * UNITS[s[-1]])
+    return int(float(s))
+
+
+def row_bytes(source) -> int:
+    """ estimates the bytes of memory needed to simulate one roll of a source """
+    if isinstance(source, list):
+        return sum([row_bytes(s) for s in source])
+    if isinstance(source, RollDef):
+        return row_bytes(source.source)
+    return BYTES_PER_DIE
+
+
+class Job(object):
+    """ a single Dist to compute or top up """
+
+    def __init__(self, name: str, rolldef: RollDef, n: int, dist: Dist = None):
+        self.name = name
+        self.rolldef = rolldef
+        self.n = n
+        self.dist = dist
+
+        self._counts = None
+        self._weighted = None
+        self._done = 0
+        self._seconds = 0.0
+
+    def remaining(self) -> int:
+        """ number of rolls still needed to reach the target """
+        have = 0 if self.dist is None else self.dist.n
+        return max(int(self.n) - int(have), 0)
+
+    @property
+    def sampler(self):
+        """ the sampling.Sampler of a weighted Dist, None for plain rolls """
+        return None if self.dist is None else self.dist.sampler
+
+    def add(self, counted: Union[np.array, Dist], bins: np.array, n: int, seconds: float):
+        """ merges the counts, or the weighted Dist, of one finished chunk into this job """
+        if isinstance(counted, Dist):
+            if self._weighted is None:
+                self._weighted = counted
+            else:
+                self._weighted = self.sampler.combine(self._weighted, counted)
+        else:
+            self._counts = accumulate_counts(self._counts, (counted, bins))
+        self._done += n
+        self._seconds += seconds
+
+    def result(self) -> Dist:
+        """ the Dist holding both prior and newly simulated rolls """
+        if self._weighted is not None:
+            return self.sampler.combine(self.dist, self._weighted)
+
+        if self._counts is None:
+            return self.dist
+
+        c, b = self._counts
+        if self.dist is not None and self.dist.n:
+            c, b = combine_counts(*self.dist.counts(), c, b)
+        return Dist.from_counts(c, b, self.rolldef)
+
+
+def _run_chunk(task):
+    """ simulates one chunk of a job in a worker process, or a weighted Dist of it """
+    job_id, rolldef, n, seed, sampler = task
+
+    start = time.perf_counter()
+    with bound_generator(np.random.default_rng(seed)):
+        if sampler is not None:
+            return job_id, sampler.dist(rolldef, n), None, n, time.perf_counter() - start
+        counted, bins = counts(rolldef(n))
+    return job_id, counted, bins, n, time.perf_counter() - start
+
+
+class Scheduler(object):
+    """
+    Splits jobs into chunks sized to fit a memory budget and balances the
+    chunks of all jobs across a pool of worker processes.
+    """
+
+    def __init__(self,
+                 workers: int = None,
+                 seed: int = None,
+                 memory_budget: int = None,
+                 verbose: bool = True):
+
+        if memory_budget is None:
+            memory_budget = 256 * UNITS["M"]
+
+        self.workers = workers
+        self.seed = seed
+        self.memory_budget = memory_budget
+        self.verbose = verbose
+
+    def _tasks(self, jobs: List[Job]):
+        entropy = np.random.SeedSequence(self.seed).entropy
+
+        tasks = []
+        for job_id, job in enumerate(jobs):
+            remaining = job.remaining()
+            chunk = max(self.memory_budget // row_bytes(job.rolldef), 1)
+            chunk_id = 0
+            while remaining > 0:
+                n = min(chunk, remaining)
+                seed = np.random.SeedSequence(entropy, spawn_key=(job_id, chunk_id))
+                tasks.append((job_id, job.rolldef, n, int(seed.generate_state(1)[0]), job.sampler))
+                remaining -= n
+                chunk_id += 1
+
+        # largest chunks first keeps the pool evenly loaded at the end of the run
+        tasks.sort(key=lambda t: -t[2] * row_bytes(t[1]))
+        return tasks
+
+    def _report(self, job: Job, finished: int, total: int):
+        if self.verbose:
+            rate = job._done / job._seconds if job._seconds else float("inf")
+            print(f"[{finished}/{total}] {job.name}: {job._done:.0f} rolls, "
+                  f"{rate:,.0f} rolls/s per worker")
+
+    def run(self, jobs: List[Job]) -> List[Dist]:
+        """ runs all jobs and returns their resulting Dists in order """
+        tasks = self._tasks(jobs)
+        pending = [0] * len(jobs)
+        for t in tasks:
+            pending[t[0]] += 1
+
+        finished = len([p for p in pending if p == 0])
+        start = time.perf_counter()
+
+        if self.workers == 1:
+            results = map(_run_chunk, tasks)
+            pool = None
+        else:
+            pool = Pool(self.workers)
+            results = pool.imap_unordered(_run_chunk, tasks)
+
+        try:
+            for job_id, counted, bins, n, seconds in results:
+                jobs[job_id].add(counted, bins, n, seconds)
+                pending[job_id] -= 1
+                if pending[job_id] == 0:
+                    finished += 1
+                    self._report(jobs[job_id], finished, len(jobs))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if self.verbose:
+            rolls = sum([t[2] for t in tasks])
+            seconds = time.perf_counter() - start
+            print(f"{rolls:.0f} rolls in {seconds:0.1f}s ({rolls / max(seconds, 1e-9):,.0f} rolls/s)")
+
+        return [job.result() for job in jobs]
+
+
+def _collect(obj, n: int, name: str, jobs: List[Job]):
+    """ finds everything in a loaded object that needs simulating """
+    if isinstance(obj, list):
+        for i, o in enumerate(obj):
+            _collect(o, n, f"{name}[{i}]", jobs)
+    elif isinstance(obj, RollDefDashboard):
+        _collect(obj.dists, n, name, jobs)
+    elif isinstance(obj, Dist):
+        if not obj.exact:
+            jobs.append(Job(getattr(obj.rolldef, "name", None) or name, obj.rolldef, n, dist=obj))
+    elif isinstance(obj, (RollDef, Die)):
+        jobs.append(Job(getattr(obj, "name", None) or name, obj, n))
+
+
+def _replace(obj, results: dict):
+    """ swaps simulated objects for their results """
+    if isinstance(obj, list):
+        return [_replace(o, results) for o in obj]
+    if isinstance(obj, RollDefDashboard):
+        obj.dists = _replace(obj.dists, results)
+        return obj
+    return results.get(id(obj), obj)
+
+
+def input_files(paths: List[Path]) -> List[Path]:
+    """ expands directories into the json files they contain """
+    files = []
+    for p in paths:
+        if p.is_dir():
+            files.extend(sorted(p.glob("*.json")))
+        else:
+            files.append(p)
+    return files
+
+
+def run(paths: List[Union[str, Path]],
+        out: Union[str, Path],
+        n: Union[int, float] = None,
+        workers: int = None,
+        seed: int = None,
+        memory_budget: int = None,
+        verbose: bool = True) -> List[Path]:
+    """
+    Computes or tops up every definition found in 'paths' and writes the
+    results into the 'out' directory, returns the written file paths.
+    """
+    if n is None:
+        n = 1e6
+
+    out = Path(out)
+    out.mkdir(parents=True, exist_ok=True)
+    serializer = Serializer()
+
+    loaded = []
+    jobs = []
+    for path in input_files([Path(p) for p in paths]):
+        target = out / path.name
+        obj = serializer.load(target if target.exists() else path)
+        start = len(jobs)
+        _collect(obj, int(n), path.stem, jobs)
+        loaded.append((target, obj, jobs[start:]))
+
+    scheduler = Scheduler(workers=workers, seed=seed,
+                          memory_budget=memory_budget, verbose=verbose)
+    dists = scheduler.run(jobs)
+
+    results = {}
+    for job, d in zip(jobs, dists):
+        key = job.rolldef if job.dist is None else job.dist
+        results[id(key)] = d
+
+    written = []
+    for target, obj, _ in loaded:
+        serializer.dump(_replace(obj, results), target)
+        written.append(target)
+    return written
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(prog="distat", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", type=Path,
+                        help="json files or directories of serialized definitions")
+    parser.add_argument("--out", "-o", type=Path, required=True,
+                        help="directory to write results to")
+    parser.add_argument("--n", type=float, default=1e6,
+                        help="total number of rolls per definition")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes, defaults to the cpu count")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--memory-budget", type=parse_bytes, default="256M",
+                        help="memory for a single chunk of rolls, such as 512M or 2G")
+    parser.add_argument("--quiet", "-q", action="store_true")
+    args = parser.parse_args(argv)
+
+    run(args.paths, args.out, n=args.n, workers=args.workers, seed=args.seed,
+        memory_budget=args.memory_budget, verbose=not args.quiet)
+
+
+if __name__ == "__main__":
+    main()
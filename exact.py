@@ -0,0 +1,236 @@
+"""
+Exact distributions of rolldefs.
+
+Closed forms are used where they exist (Count over plain dice). Otherwise
+the outcomes of the source pool are enumerated with their probabilities
+and the rolldef's ops are run over that table of outcomes. When the ops do
+not depend on the order of the dice, only the sorted multisets of each
+group of identical dice are enumerated, weighted by multinomial
+coefficients, which is far fewer outcomes than every ordered tuple.
+"""
+from itertools import combinations_with_replacement
+from math import lgamma, log
+from typing import Optional, Tuple, Union
+import numpy as np
+
+from classes import Die, RollDef, Count, Dist, Filter, Position, Highest, Lowest, \
+    Aggregator, Action, ReRoll
+from util import mean_from_dist, median_from_dist
+
+
+# largest table of outcomes that will be enumerated before declining
+MAX_OUTCOMES = 10 ** 6
+
+
+def die_pmf(die: Die) -> Tuple[np.array, np.array]:
+    """ returns the unique face values of a die and their probabilities """
+    faces, counts = np.unique(np.array(die._faces), return_counts=True)
+    return faces, counts / die._n_sides
+
+
+def binomial_pmf(k: int, p: float) -> np.array:
+    """
+    probability of 0 through k successes in k trials of probability p.
+    evaluated in log space so that large pools do not overflow.
+    """
+    if p <= 0:
+        pmf = np.zeros(k + 1)
+        pmf[0] = 1.0
+        return pmf
+    if p >= 1:
+        pmf = np.zeros(k + 1)
+        pmf[k] = 1.0
+        return pmf
+
+    j = np.arange(k + 1)
+    log_comb = np.array([lgamma(k + 1) - lgamma(i + 1) - lgamma(k - i + 1) for i in j])
+    return np.exp(log_comb + j * log(p) + (k - j) * log(1 - p))
+
+
+def dist_from_pmf(pmf: np.array, first: int, rolldef: RollDef) -> Dist:
+    """ builds an exact Dist from probabilities of consecutive integers starting at 'first' """
+
+    # trim impossible outcomes from both ends so bins match a sampled Dist
+    nonzero = np.flatnonzero(pmf)
+    pmf = pmf[nonzero[0]: nonzero[-1] + 1]
+    first = first + nonzero[0]
+
+    values = pmf / np.sum(pmf)
+    bins = np.arange(first, first + len(values) + 1)
+    return Dist(values=values, bins=bins, rolldef=rolldef,
+                mean=mean_from_dist(values, bins),
+                median=median_from_dist(values, bins),
+                n=None, exact=True)
+
+
+def _count_pmf(rolldef: RollDef) -> Optional[np.array]:
+    """
+    Count of a pool of plain dice. Each die matches the selectors with a fixed
+    probability, so identical dice give a binomial pmf and groups of different
+    dice are combined by convolution.
+    """
+    if len(rolldef.ops) != 1 or not isinstance(rolldef.ops[0], Count):
+        return None
+
+    pool = rolldef.source if isinstance(rolldef.source, list) else [rolldef.source]
+    if not all([isinstance(s, Die) for s in pool]):
+        return None
+
+    count = rolldef.ops[0]
+    groups = {}
+    for die in pool:
+        faces, probs = die_pmf(die)
+        p = float(np.sum(probs[count.select(faces.reshape(-1, 1)).ravel()]))
+        groups[p] = groups.get(p, 0) + 1
+
+    pmf = np.ones(1)
+    for p, k in groups.items():
+        pmf = np.convolve(pmf, binomial_pmf(k, p))
+    return pmf
+
+
+def source_pmf(source, max_outcomes: int = None) -> Optional[Tuple[np.array, np.array]]:
+    """ the possible values of a single die or rolldef and their probabilities """
+    if isinstance(source, Die):
+        return die_pmf(source)
+
+    if isinstance(source, RollDef):
+        d = exact_dist(source, max_outcomes)
+        if d is not None:
+            possible = d.values > 0
+            return d.bins[:-1][possible], d.values[possible]
+
+    return None
+
+
+def _order_matters(ops) -> bool:
+    """ True if the ops give different results for reordered dice in the pool """
+    for op in ops:
+        if isinstance(op, (Highest, Lowest)):
+            return False
+        if isinstance(op, Position):
+            return True
+        if isinstance(op, Aggregator):
+            return any([isinstance(o, Position) for o in op.ops])
+    return False
+
+
+def _multisets(values: np.array, probs: np.array, k: int):
+    """ sorted multisets of k draws from one pmf, with their probabilities """
+    faces = np.array(list(combinations_with_replacement(range(len(values)), k)),
+                     dtype=np.int64).reshape(-1, k)
+
+    # multinomial coefficient k! / prod(c!) times prod(p ** c) for face counts c
+    face_counts = np.zeros((len(faces), len(values)), dtype=np.int64)
+    np.add.at(face_counts, (np.arange(len(faces)).repeat(k), faces.ravel()), 1)
+    log_fact = np.array([lgamma(i + 1) for i in range(k + 1)])
+    log_w = log_fact[k] - np.sum(log_fact[face_counts], axis=1) + face_counts @ np.log(probs)
+    return values[faces], np.exp(log_w)
+
+
+def _n_multisets(faces: int, k: int) -> float:
+    """ number of sorted multisets of k draws from 'faces' values """
+    return round(np.exp(lgamma(faces + k) - lgamma(k + 1) - lgamma(faces)))
+
+
+def _product(tables):
+    """ every combination of the rows of several outcome tables """
+    values, weights = tables[0]
+    for v, w in tables[1:]:
+        values = np.hstack((np.repeat(values, len(v), axis=0), np.tile(v, (len(values), 1))))
+        weights = np.outer(weights, w).ravel()
+    return values, weights
+
+
+def _outcomes(rolldef: RollDef, max_outcomes: int):
+    """ table of all outcomes of the source of a rolldef with their probabilities """
+    if not isinstance(rolldef.source, list):
+        return source_pmf(rolldef.source, max_outcomes)
+
+    pmfs = [source_pmf(s, max_outcomes) for s in rolldef.source]
+    if any([p is None for p in pmfs]):
+        return None
+
+    # every ordered tuple, in the order of the sources
+    if _order_matters(rolldef.ops):
+        if np.prod([float(len(v)) for v, _ in pmfs]) > max_outcomes:
+            return None
+        return _product([(v.reshape(-1, 1), p) for v, p in pmfs])
+
+    # multisets of each group of identically distributed sources
+    groups = {}
+    for v, p in pmfs:
+        key = (v.tobytes(), p.tobytes())
+        groups.setdefault(key, [v, p, 0])[2] += 1
+
+    if np.prod([_n_multisets(len(v), k) for v, _, k in groups.values()]) > max_outcomes:
+        return None
+
+    return _product([_multisets(v, p, k) for v, p, k in groups.values()])
+
+
+def _enumerated_pmf(rolldef: RollDef, max_outcomes: int) -> Optional[Tuple[np.array, int]]:
+    """ runs the ops of a rolldef over the table of enumerated outcomes """
+    table = _outcomes(rolldef, max_outcomes)
+    if table is None:
+        return None
+    values, weights = table
+    rerolls = None
+
+    for op in rolldef.ops:
+        if isinstance(op, Action):
+            if not isinstance(op, ReRoll) or len(values.shape) > 1:
+                return None
+
+            # rerolled outcomes are replaced by a fresh roll of the source
+            selected = op.select(values)
+            if rerolls is None:
+                rerolls = source_pmf(rolldef.source, max_outcomes)
+            values = np.hstack((values[~selected], rerolls[0]))
+            weights = np.hstack((weights[~selected], np.sum(weights[selected]) * rerolls[1]))
+
+        elif isinstance(op, (Aggregator, Filter)):
+            values = op(values)
+
+    if len(values.shape) > 1:
+        if values.shape[1] != 1:
+            return None
+        values = values.ravel()
+
+    values = np.asarray(values)
+    if not np.issubdtype(values.dtype, np.integer):
+        return None
+
+    low = int(np.min(values))
+    return np.bincount(values - low, weights=weights), low
+
+
+def exact_dist(rolldef: RollDef, max_outcomes: int = None) -> Optional[Dist]:
+    """
+    Computes the exact distribution of a rolldef, returns None if there
+    is no exact method for it or if more than 'max_outcomes' outcomes
+    would have to be enumerated.
+    """
+    if max_outcomes is None:
+        max_outcomes = MAX_OUTCOMES
+
+    pmf = _count_pmf(rolldef)
+    if pmf is not None:
+        return dist_from_pmf(pmf, 0, rolldef)
+
+    enumerated = _enumerated_pmf(rolldef, max_outcomes)
+    if enumerated is not None:
+        return dist_from_pmf(enumerated[0], enumerated[1], rolldef)
+
+    return None
+
+
+def exact_or_sampled(rolldef: RollDef, n: Union[int, float] = None) -> Dist:
+    """
+    The exact distribution of a rolldef where a method exists for it, and
+    a Dist of 'n' sampled rolls otherwise.
+    """
+    d = exact_dist(rolldef)
+    if d is None:
+        d = Dist.calc(rolldef, n)
+    return d
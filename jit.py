@@ -0,0 +1,257 @@
+"""
+Optional numba backend. A supported rolldef is compiled into a flat plan
+of arrays, and one parallel kernel loops over rolls drawing the dice,
+rerolling, selecting the highest or lowest dice, summing or counting, and
+incrementing a histogram, without any intermediate arrays.
+
+Supported rolldefs are a pool of dice, where each die is a Die or a
+RollDef of a Die with only ReRoll ops, aggregated by Sum(), Sum(Highest(m)),
+Sum(Lowest(m)) or Count(...), optionally wrapped in a RollDef with ReRoll
+ops on the aggregate. That covers the attribute rolls in tests.py.
+
+Each roll draws from its own counter based random stream, so for a given
+seed the result is identical regardless of the number of threads. Streams
+differ from numpy's, so results only match the numpy backend in
+distribution. Without numba installed, jit_dist falls back to Dist.calc.
+"""
+from typing import Optional, Union
+import numpy as np
+
+from classes import Die, RollDef, Dist, ReRoll, Sum, Count, All, Highest, Lowest
+
+try:
+    import numba
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+
+SUM_ALL, SUM_HIGHEST, SUM_LOWEST, COUNT = 0, 1, 2, 3
+
+
+class Plan(object):
+    """ arrays describing a rolldef for the kernel """
+
+    def __init__(self, faces, n_faces, die_rerolls, mode, m,
+                 count_table, value_low, stat_rerolls, stat_low, stat_high):
+        self.faces = faces
+        self.n_faces = n_faces
+        self.die_rerolls = die_rerolls
+        self.mode = mode
+        self.m = m
+        self.count_table = count_table
+        self.value_low = value_low
+        self.stat_rerolls = stat_rerolls
+        self.stat_low = stat_low
+        self.stat_high = stat_high
+
+
+def _die_spec(source):
+    """ faces of a die and the faces rerolled in each round, or None """
+    if isinstance(source, Die):
+        return np.array(source._faces, dtype=np.int64), []
+
+    if isinstance(source, RollDef) and isinstance(source.source, Die):
+        if all([isinstance(op, ReRoll) for op in source.ops]):
+            faces = np.array(source.source._faces, dtype=np.int64)
+            return faces, [op.select(faces) for op in source.ops]
+
+    return None
+
+
+def _stat_spec(source):
+    """ dice specs, aggregation mode and its argument of a pool, or None """
+    die = _die_spec(source)
+    if die is not None:
+        return [die], SUM_ALL, 1, None
+
+    if not isinstance(source, RollDef) or not isinstance(source.source, list):
+        return None
+    if len(source.ops) != 1:
+        return None
+
+    dice = [_die_spec(s) for s in source.source]
+    if any([d is None for d in dice]):
+        return None
+
+    op = source.ops[0]
+    if isinstance(op, Count):
+        return dice, COUNT, len(dice), op
+
+    if type(op) is Sum and len(op.ops) == 1:
+        inner = op.ops[0]
+        if isinstance(inner, All):
+            return dice, SUM_ALL, len(dice), None
+        if isinstance(inner, Highest) and inner.n is not None and 0 < inner.n <= len(dice):
+            return dice, SUM_HIGHEST, inner.n, None
+        if isinstance(inner, Lowest) and inner.n is not None and 0 < inner.n <= len(dice):
+            return dice, SUM_LOWEST, inner.n, None
+
+    return None
+
+
+def compile_rolldef(rolldef: RollDef) -> Optional[Plan]:
+    """ lowers a rolldef into a Plan, returns None if it is not supported """
+    stat_ops = []
+    spec = _stat_spec(rolldef)
+    if spec is None and isinstance(rolldef, RollDef):
+        if rolldef.ops and all([isinstance(op, ReRoll) for op in rolldef.ops]):
+            spec = _stat_spec(rolldef.source)
+            stat_ops = rolldef.ops
+    if spec is None:
+        return None
+
+    dice, mode, m, count = spec
+    k = len(dice)
+    width = max([len(f) for f, _ in dice])
+    rounds = max([len(r) for _, r in dice])
+
+    faces = np.zeros((k, width), dtype=np.int64)
+    n_faces = np.zeros(k, dtype=np.int64)
+    die_rerolls = np.zeros((k, max(rounds, 1), width), dtype=np.bool_)
+    for j, (f, rerolls) in enumerate(dice):
+        faces[j, :len(f)] = f
+        n_faces[j] = len(f)
+        for r, mask in enumerate(rerolls):
+            die_rerolls[j, r, :len(f)] = mask
+
+    value_low = min([int(f.min()) for f, _ in dice])
+    value_high = max([int(f.max()) for f, _ in dice])
+    values = np.arange(value_low, value_high + 1)
+    if count is not None:
+        count_table = count.select(values.reshape(-1, 1)).ravel()
+        stat_low, stat_high = 0, k
+    else:
+        count_table = np.zeros(1, dtype=np.bool_)
+        stat_low, stat_high = m * value_low, m * value_high
+
+    stats = np.arange(stat_low, stat_high + 1)
+    stat_rerolls = np.zeros((len(stat_ops), len(stats)), dtype=np.bool_)
+    for r, op in enumerate(stat_ops):
+        stat_rerolls[r] = op.select(stats)
+
+    return Plan(faces, n_faces, die_rerolls, mode, m, count_table.astype(np.bool_),
+                value_low, stat_rerolls, stat_low, stat_high)
+
+
+# Kernel ==================================================
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+@njit(cache=True)
+def _mix(z):
+    z = (z ^ (z >> np.uint64(30))) * MIX1
+    z = (z ^ (z >> np.uint64(27))) * MIX2
+    return z ^ (z >> np.uint64(31))
+
+
+@njit(cache=True)
+def _uniform(state, bound):
+    """ advances a splitmix64 state, returns it with an integer in [0, bound) """
+    state = state + GOLDEN
+    z = _mix(state)
+    return state, np.int64(((z >> np.uint64(32)) * np.uint64(bound)) >> np.uint64(32))
+
+
+@njit(cache=True)
+def _roll_die(state, j, faces, n_faces, die_rerolls):
+    state, idx = _uniform(state, n_faces[j])
+    for r in range(die_rerolls.shape[1]):
+        if die_rerolls[j, r, idx]:
+            state, idx = _uniform(state, n_faces[j])
+    return state, faces[j, idx]
+
+
+@njit(cache=True)
+def _roll_stat(state, buf, faces, n_faces, die_rerolls, mode, m, count_table, value_low):
+    k = faces.shape[0]
+    for j in range(k):
+        state, buf[j] = _roll_die(state, j, faces, n_faces, die_rerolls)
+
+    if mode == COUNT:
+        total = 0
+        for j in range(k):
+            if count_table[buf[j] - value_low]:
+                total += 1
+        return state, total
+
+    if mode != SUM_ALL:
+        # insertion sort, pools are small
+        for j in range(1, k):
+            v = buf[j]
+            i = j - 1
+            while i >= 0 and buf[i] > v:
+                buf[i + 1] = buf[i]
+                i -= 1
+            buf[i + 1] = v
+
+    start, stop = 0, k
+    if mode == SUM_HIGHEST:
+        start = k - m
+    elif mode == SUM_LOWEST:
+        stop = m
+
+    total = 0
+    for j in range(start, stop):
+        total += buf[j]
+    return state, total
+
+
+@njit(parallel=True, cache=True)
+def _kernel(n, seed, faces, n_faces, die_rerolls, mode, m, count_table, value_low,
+            stat_rerolls, stat_low, hist):
+    n_blocks = hist.shape[0]
+    block = (n + n_blocks - 1) // n_blocks
+    for b in prange(n_blocks):
+        buf = np.empty(faces.shape[0], dtype=np.int64)
+        for row in range(b * block, min(n, (b + 1) * block)):
+            state = _mix(seed + np.uint64(row) * GOLDEN)
+            state, stat = _roll_stat(state, buf, faces, n_faces, die_rerolls,
+                                     mode, m, count_table, value_low)
+            for r in range(stat_rerolls.shape[0]):
+                if stat_rerolls[r, stat - stat_low]:
+                    state, stat = _roll_stat(state, buf, faces, n_faces, die_rerolls,
+                                             mode, m, count_table, value_low)
+            hist[b, stat - stat_low] += 1
+
+
+def jit_counts(plan: Plan, n: int, seed: int):
+    """ runs the kernel, returns integer counts and bins """
+    n_blocks = numba.get_num_threads() * 4
+    hist = np.zeros((n_blocks, plan.stat_high - plan.stat_low + 1), dtype=np.int64)
+    _kernel(int(n), np.uint64(seed), plan.faces, plan.n_faces, plan.die_rerolls,
+            plan.mode, plan.m, plan.count_table, plan.value_low,
+            plan.stat_rerolls, plan.stat_low, hist)
+
+    counted = hist.sum(axis=0)
+    nonzero = np.flatnonzero(counted)
+    counted = counted[nonzero[0]: nonzero[-1] + 1]
+    low = plan.stat_low + nonzero[0]
+    return counted, np.arange(low, low + len(counted) + 1)
+
+
+def jit_dist(rolldef: RollDef, n: Union[int, float] = None, seed: int = None) -> Dist:
+    """
+    Computes a Dist of 'n' rolls with the numba kernel, or with Dist.calc
+    if numba is not installed or the rolldef is not supported.
+    """
+    if n is None:
+        n = 1e6
+
+    plan = compile_rolldef(rolldef) if HAVE_NUMBA else None
+    if plan is None:
+        return Dist.calc(rolldef=rolldef, n=n)
+
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    counted, bins = jit_counts(plan, int(n), int(seed) & 0xFFFFFFFFFFFFFFFF)
+    return Dist.from_counts(counted, bins, rolldef)
@@ -0,0 +1,163 @@
+"""
+Variance reduction for rare tail probabilities.
+
+Importance sampling draws every die face with probability proportional
+to exp(tilt * z), where z is the face's position between the die's lowest
+(0) and highest (1) value, so a positive tilt favours high rolls. Each roll
+carries the likelihood ratio of all of its draws, including rerolls, as a
+weight into the histogram. Stratified sampling draws the first die of each
+roll in fixed proportions instead of at random.
+
+    d = Dist.calc(RollDef(10 * D(6), Sum()), n=1e5, sampler=Sampler(tilt=5))
+    d.prob_at_least(58), tail_error(d, 58)
+"""
+from typing import Tuple, Union
+import numpy as np
+
+from classes import Die, RollDef, Dist, ReRoll, Action, Aggregator, Filter
+from util import combine_counts, mean_from_dist, median_from_dist, generator
+
+
+class Sampler(object):
+    """ draws weighted rolls of a rolldef """
+
+    def __init__(self, tilt: float = 0.0, stratify: bool = False):
+        """
+        :param tilt: exponential tilt of the face probabilities of every die,
+                     0 leaves them unbiased
+        :param stratify: draws the first die of each roll in proportion to its
+                         face probabilities instead of at random, with at least
+                         one roll per face. Fewer rolls than faces are drawn at random
+        """
+        self.tilt = tilt
+        self.stratify = stratify
+
+        self._stratify_next = False
+
+    def proposal(self, die: Die) -> Tuple[np.array, np.array]:
+        """ the face values of a die and the probabilities they are drawn with """
+        faces = np.array(die._faces)
+        spread = faces.max() - faces.min()
+        z = (faces - faces.min()) / spread if spread else np.zeros(len(faces))
+
+        q = np.exp(self.tilt * z)
+        return faces, q / np.sum(q)
+
+    def _draw_die(self, die: Die, n: int) -> Tuple[np.array, np.array]:
+        faces, q = self.proposal(die)
+
+        # every face needs a draw, a face left out would lose its probability
+        if self._stratify_next and n >= len(faces):
+            self._stratify_next = False
+
+            # one roll per face, the rest by largest remainder allocation proportional to q
+            exact = q * (n - len(faces))
+            allocated = np.floor(exact).astype(np.int64)
+            short = n - len(faces) - np.sum(allocated)
+            allocated[np.argsort(allocated - exact)[:short]] += 1
+            allocated += 1
+            idx = np.repeat(np.arange(len(faces)), allocated)
+            drawn = allocated / n
+        else:
+            gen = generator()
+            uniform = np.random.random(n) if gen is None else gen.random(n)
+            idx = np.searchsorted(np.cumsum(q), uniform, side="right")
+            idx = np.minimum(idx, len(faces) - 1)
+            drawn = q
+
+        log_w = np.log(1.0 / len(faces)) - np.log(drawn[idx])
+        return faces[idx], log_w
+
+    def _draw(self, source, n: int) -> Tuple[np.array, np.array]:
+        """ rolls and log likelihood ratios of a source """
+        if isinstance(source, list):
+            drawn = [self._draw(s, n) for s in source]
+            return np.column_stack([d[0] for d in drawn]), np.sum([d[1] for d in drawn], axis=0)
+
+        if isinstance(source, Die):
+            return self._draw_die(source, n)
+
+        if not isinstance(source, RollDef):
+            raise TypeError(f"can not sample {source} with weights")
+
+        rolls, log_w = self._draw(source.source, n)
+        for op in source.ops:
+            if isinstance(op, ReRoll):
+                if len(rolls.shape) > 1:
+                    raise ValueError("ReRoll of a pool")
+                selected = op.select(rolls)
+                n_rerolls = np.count_nonzero(selected)
+                if n_rerolls > 0:
+                    rerolls, reroll_w = self._draw(source.source, n_rerolls)
+                    rolls[selected] = rerolls
+                    log_w[selected] += reroll_w
+
+            elif isinstance(op, Action):
+                raise TypeError(f"can not sample {op} with weights")
+
+            elif isinstance(op, (Aggregator, Filter)):
+                rolls = op(rolls)
+
+        return rolls, log_w
+
+    def __call__(self, rolldef: RollDef, n: Union[int, float]) -> Tuple[np.array, np.array]:
+        """ returns n rolls of the rolldef and their weights """
+        self._stratify_next = self.stratify
+        rolls, log_w = self._draw(rolldef, int(n))
+        return np.asarray(rolls).ravel(), np.exp(log_w)
+
+    def dist(self, rolldef: RollDef, n: Union[int, float]) -> Dist:
+        """ a weighted Dist of n rolls """
+        rolls, w = self(rolldef, n)
+        low = int(np.min(rolls))
+        weights = np.bincount(rolls - low, weights=w)
+        weights_sq = np.bincount(rolls - low, weights=w * w)
+        bins = np.arange(low, low + len(weights) + 1)
+        return self._from_weights(weights, weights_sq, bins, rolldef, int(n))
+
+    def combine(self, d1: Dist, d2: Dist) -> Dist:
+        """ combines two weighted Dists of the same rolldef """
+        weights, bins = combine_counts(d1.weights, d1.bins, d2.weights, d2.bins)
+        weights_sq, _ = combine_counts(d1.weights_sq, d1.bins, d2.weights_sq, d2.bins)
+        return self._from_weights(weights, weights_sq, bins, d1.rolldef, int(d1.n + d2.n))
+
+    def _from_weights(self, weights, weights_sq, bins, rolldef, n) -> Dist:
+        # unbiased, but unlike self normalized weights only sums to 1 on average
+        values = weights / n
+        return Dist(values=values, bins=bins, rolldef=rolldef,
+                    mean=mean_from_dist(values, bins),
+                    median=median_from_dist(values, bins),
+                    n=n, weights=weights, weights_sq=weights_sq,
+                    ess=np.sum(weights) ** 2 / np.sum(weights_sq),
+                    sampler=self)
+
+
+def tail_error(d: Dist, k: int) -> float:
+    """ estimated relative standard error of P(X >= k) of a weighted Dist """
+    tail = d.bins[:-1] >= k
+    w = np.sum(d.weights[tail])
+    if w == 0:
+        return np.inf
+
+    # variance of the mean of w * 1[x >= k] over n rolls
+    variance = (np.sum(d.weights_sq[tail]) / d.n - (w / d.n) ** 2) / d.n
+    return float(np.sqrt(max(variance, 0.0)) / (w / d.n))
+
+
+def calc_tail(rolldef: RollDef,
+              k: int,
+              rel_error: float = 0.05,
+              sampler: Sampler = None,
+              chunk: Union[int, float] = 1e5,
+              max_n: Union[int, float] = 1e9) -> Dist:
+    """
+    Adds weighted rolls in chunks until P(X >= k) reaches the relative
+    error target, or max_n rolls have been drawn.
+    """
+    if sampler is None:
+        sampler = Sampler()
+
+    d = sampler.dist(rolldef, chunk)
+    while tail_error(d, k) > rel_error and d.n < max_n:
+        d.add_accuracy(chunk)
+    return d
@@ -1,14 +1,25 @@
 import simplejson as json
 import classes
+import sampling
 import viz
 import numpy as np
 
 from pathlib import Path
-from typing import Dict, Union
+from typing import Dict, List, Union
 
 
 CLASS_NAME_KEY = "1_class_name__"
 CLASS_ATTRIBUTES_KEY = "2_class_attributes__"
+REF_KEY = "3_ref__"
+
+# version of the DAG format written by Serializer.dump, files without one are the nested format 1
+FORMAT_KEY = "format"
+NODES_KEY = "nodes"
+ROOT_KEY = "root"
+FORMAT = 2
+
+# stateless definitions, structurally identical instances of these are written once
+DEFINITION_CLASSES = (classes.Source, classes.Filter, classes.Selector, classes.Aggregator, classes.Action)
 
 
 def _to_json(obj: object):
@@ -41,7 +52,7 @@ def _to_json(obj: object):
         return [_to_json(element) for element in obj]
 
     if isinstance(obj, tuple):
-        return (_to_json(element) for element in obj)
+        return [_to_json(element) for element in obj]
 
     # special to serialize numpy arrays to lists
     if isinstance(obj, np.ndarray):
@@ -49,7 +60,7 @@ def _to_json(obj: object):
              CLASS_ATTRIBUTES_KEY: {"object": obj.tolist()}}
         return d
     if isinstance(obj, np.int64):
-        return np.asscalar(obj)
+        return obj.item()
     else:
         return obj
 
@@ -75,13 +86,95 @@ def _from_json(obj: object, class_dict: Dict):
     elif isinstance(obj, list):
         return [_from_json(element, class_dict) for element in obj]
 
-    elif isinstance(obj, tuple):
-        return (_from_json(element, class_dict) for element in obj)
-
     else:
         return obj
 
 
+def _attributes(obj: object) -> Dict:
+    """ the attributes of a class instance that are serialized """
+    return {k: v for k, v in obj.__dict__.items() if not k.startswith('_')}
+
+
+def _children(obj: object) -> List:
+    if isinstance(obj, np.ndarray):
+        return []
+    if hasattr(obj, "__dict__"):
+        return list(_attributes(obj).values())
+    if isinstance(obj, (list, tuple)):
+        return list(obj)
+    return []
+
+
+def _to_dag(root: object) -> Dict:
+    """
+    Converts classes to the DAG format. Every class instance becomes a node,
+    written after the nodes it refers to, and is referred to by its index in
+    the node list. Instances shared in memory are written once, and so are
+    structurally identical definitions (dice, ops and rolldefs), which are
+    found by the json of their node, as their children are already written.
+    The object graph is walked with an explicit stack rather than recursion.
+    """
+    nodes = []
+    definitions = {}
+    encoded = {}
+    alive = []  # objects are held so that their ids are not reused while encoding
+
+    stack = [(root, False)]
+    while stack:
+        obj, expanded = stack.pop()
+        if id(obj) in encoded:
+            continue
+
+        children = _children(obj)
+        if not expanded and children:
+            stack.append((obj, True))
+            stack.extend([(c, False) for c in reversed(children) if id(c) not in encoded])
+            continue
+
+        alive.append(obj)
+        if isinstance(obj, np.ndarray) or not hasattr(obj, "__dict__"):
+            if isinstance(obj, (list, tuple)):
+                encoded[id(obj)] = [encoded[id(c)] for c in obj]
+            else:
+                encoded[id(obj)] = _to_json(obj)
+            continue
+
+        node = {CLASS_NAME_KEY: obj.__class__.__name__,
+                CLASS_ATTRIBUTES_KEY: {k: encoded[id(v)] for k, v in _attributes(obj).items()}}
+
+        key = json.dumps(node, sort_keys=True) if isinstance(obj, DEFINITION_CLASSES) else None
+        if key in definitions:
+            encoded[id(obj)] = {REF_KEY: definitions[key]}
+            continue
+
+        nodes.append(node)
+        encoded[id(obj)] = {REF_KEY: len(nodes) - 1}
+        if key is not None:
+            definitions[key] = len(nodes) - 1
+
+    return {FORMAT_KEY: FORMAT, NODES_KEY: nodes, ROOT_KEY: encoded[id(root)]}
+
+
+def _from_dag(dag: Dict, class_dict: Dict):
+    """ instantiates the nodes of the DAG format in order, restoring shared references """
+    instances = []
+
+    def resolve(value):
+        if isinstance(value, dict):
+            if REF_KEY in value:
+                return instances[value[REF_KEY]]
+            return class_dict[value[CLASS_NAME_KEY]](value[CLASS_ATTRIBUTES_KEY]["object"])  # an array
+        if isinstance(value, list):
+            return [resolve(v) for v in value]
+        return value
+
+    for node in dag[NODES_KEY]:
+        cls = class_dict[node[CLASS_NAME_KEY]]
+        instances.append(cls(**{k: resolve(v) for k, v in node[CLASS_ATTRIBUTES_KEY].items()}))
+
+    return resolve(dag[ROOT_KEY])
+
+
 class Serializer(object):
     """
     Based on a fairly simple method of turning every distat
@@ -109,11 +202,13 @@ class Serializer(object):
             classes.Aggregator,
             classes.Sum,
             classes.Difference,
+            classes.Count,
             classes.Action,
             classes.ReRoll,
             classes.RollDef_,
             classes.RollDef,
             classes.Dist,
+            sampling.Sampler,
             viz.RollDefDashboard,
         ]
 
@@ -123,11 +218,9 @@ class Serializer(object):
         self.class_dict.update({"ndarray": np.array})
 
     @staticmethod
-    def dump(obj: object, path: Path = None):
-        """ converts object """
-        objson = _to_json(obj)
-        from pprint import pprint
-        pprint(objson)
+    def dump(obj: object, path: Path = None, format: int = FORMAT):
+        """ converts object, in the DAG format or the nested format 1 """
+        objson = _to_dag(obj) if format == FORMAT else _to_json(obj)
         dump = json.dumps(objson, indent=4, sort_keys=True)
 
         if path is not None:
@@ -142,5 +235,9 @@ class Serializer(object):
             with open(s, 'r') as f:
                 s = f.read()
 
-        load = _from_json(json.loads(s), self.class_dict)
+        objson = json.loads(s)
+        if isinstance(objson, dict) and objson.get(FORMAT_KEY) == FORMAT:
+            return _from_dag(objson, self.class_dict)
+
+        load = _from_json(objson, self.class_dict)
         return load
@@ -0,0 +1,236 @@
+"""
+Local query service answering distribution requests from a cache.
+
+    python service.py --port 8765 --workers 4
+
+Clients connect over localhost TCP (or a unix socket with --path) and send
+one json request per line, each answered by one json line:
+
+    {"op": "dist", "rolldef": <Serializer json>, "n": 1e6}
+        -> {"key": ..., "n": ..., "mean": ..., "median": ..., "values": [...], "bins": [...]}
+    {"op": "stat", "key": ..., "stat": "mean" | "median" | "percentile" | "at_least", "arg": ...}
+        -> {"key": ..., "value": ...}
+
+A "stat" request may give "rolldef" and "n" instead of a "key". Dists are
+kept in a least recently used cache keyed by the rolldef json and n.
+Identical requests arriving while a Dist is being simulated wait on the
+same simulation, and simulations run in a process pool so the event loop
+keeps answering queries meanwhile.
+"""
+import argparse
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Dict, Tuple, Union
+
+import numpy as np
+import simplejson as json
+
+from classes import Dist
+from exact import exact_or_sampled
+from serializer import Serializer
+from util import mean_from_dist, median_from_dist
+
+
+# longest request or response line, serialized rolldefs easily exceed asyncio's 64 KiB default
+LIMIT = 2 ** 26
+
+
+def request_key(rolldef: Dict, n: float, exact: bool = False) -> str:
+    """ a cache key identifying a rolldef json and the number of rolls """
+    canonical = json.dumps([rolldef, float(n), bool(exact)], sort_keys=True)
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+
+def _scalar(x):
+    """ numpy scalars as plain python numbers for json """
+    return x.item() if isinstance(x, np.generic) else x
+
+
+def _compute(rolldef: str, n: float, exact: bool) -> Tuple:
+    """ simulates a serialized rolldef in a worker process """
+    rd = Serializer().load(rolldef)
+    d = exact_or_sampled(rd, n) if exact else rd.dist(n)
+    return d.values, d.bins, d.n, d.exact
+
+
+class DistService(object):
+    """ caches Dists and answers statistic queries about them """
+
+    def __init__(self, workers: int = None, cache_size: int = 256, executor: Executor = None):
+        if executor is None:
+            executor = ProcessPoolExecutor(workers)
+
+        self.cache_size = cache_size
+
+        self._executor = executor
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._serializer = Serializer()
+
+    def _remember(self, key: str, d: Dist):
+        self._cache[key] = d
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def get(self, rolldef: Dict, n: float = None, exact: bool = False) -> Tuple[str, Dist]:
+        """ the cached Dist of a rolldef json, simulated if needed """
+        if n is None:
+            n = 1e6
+
+        key = request_key(rolldef, n, exact)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return key, self._cache[key]
+
+        # identical requests share the simulation already underway
+        if key not in self._inflight:
+            self._inflight[key] = asyncio.ensure_future(self._simulate(key, rolldef, n, exact))
+        return key, await asyncio.shield(self._inflight[key])
+
+    async def _simulate(self, key: str, rolldef: Dict, n: float, exact: bool) -> Dist:
+        try:
+            loop = asyncio.get_running_loop()
+            values, bins, sims, is_exact = await loop.run_in_executor(
+                self._executor, _compute, json.dumps(rolldef), n, exact)
+
+            d = Dist(values=values, bins=bins,
+                     rolldef=self._serializer.load(json.dumps(rolldef)),
+                     mean=mean_from_dist(values, bins),
+                     median=median_from_dist(values, bins),
+                     n=sims, exact=is_exact)
+            self._remember(key, d)
+            return d
+        finally:
+            del self._inflight[key]
+
+    async def handle(self, request: Dict) -> Dict:
+        """ answers a single request """
+        op = request.get("op")
+
+        if op == "dist":
+            key, d = await self.get(request["rolldef"], request.get("n"), request.get("exact", False))
+            return {"key": key, "n": d.n, "exact": d.exact,
+                    "mean": _scalar(d.mean), "median": _scalar(d.median),
+                    "values": d.values.tolist(), "bins": d.bins.tolist()}
+
+        if op == "stat":
+            if "key" in request:
+                key = request["key"]
+                if key not in self._cache:
+                    raise KeyError(f"{key} is not cached, send the rolldef instead")
+                d = self._cache[key]
+                self._cache.move_to_end(key)
+            else:
+                key, d = await self.get(request["rolldef"], request.get("n"), request.get("exact", False))
+            return {"key": key, "value": self.stat(d, request["stat"], request.get("arg"))}
+
+        raise ValueError(f"unknown op {op}")
+
+    @staticmethod
+    def stat(d: Dist, stat: str, arg: float = None):
+        """ computes a statistic of a Dist """
+        if stat == "mean":
+            return _scalar(d.mean)
+        if stat == "median":
+            return _scalar(d.median)
+        if stat == "percentile":
+            return _scalar(d.percentile(arg))
+        if stat == "at_least":
+            return d.prob_at_least(arg)
+        raise ValueError(f"unknown stat {stat}")
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError) as e:
+                    # the rest of an overlong line can not be told from the next request
+                    writer.write(json.dumps({"error": f"request over {LIMIT} bytes: {e}"}).encode() + b"\n")
+                    await writer.drain()
+                    break
+                if not line:
+                    break
+                try:
+                    response = await self.handle(json.loads(line))
+                except Exception as e:
+                    response = {"error": f"{e.__class__.__name__}: {e}"}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # the client went away, or the server is shutting down
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8765, path: str = None) -> asyncio.AbstractServer:
+        """ starts listening on localhost, or on a unix socket if a path is given """
+        if path is not None:
+            return await asyncio.start_unix_server(self._client, path=path, limit=LIMIT)
+        return await asyncio.start_server(self._client, host=host, port=port, limit=LIMIT)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Client(object):
+    """ asyncio client holding one connection to a DistService """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+
+    @classmethod
+    async def connect(cls, host: str = "127.0.0.1", port: int = 8765, path: str = None):
+        if path is not None:
+            return cls(*await asyncio.open_unix_connection(path, limit=LIMIT))
+        return cls(*await asyncio.open_connection(host, port, limit=LIMIT))
+
+    async def request(self, request: Dict) -> Dict:
+        self._writer.write(json.dumps(request).encode() + b"\n")
+        await self._writer.drain()
+        response = json.loads(await self._reader.readline())
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    async def dist(self, rolldef, n: float = None, exact: bool = False) -> Dict:
+        """ requests the Dist of a rolldef, either an object or its Serializer json """
+        if not isinstance(rolldef, (dict, str)):
+            rolldef = Serializer.dump(rolldef)
+        if isinstance(rolldef, str):
+            rolldef = json.loads(rolldef)
+        return await self.request({"op": "dist", "rolldef": rolldef, "n": n, "exact": exact})
+
+    async def stat(self, key: str, stat: str, arg: Union[int, float] = None):
+        return (await self.request({"op": "stat", "key": key, "stat": stat, "arg": arg}))["value"]
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+
+
+async def _serve(host: str, port: int, path: str, workers: int, cache_size: int):
+    service = DistService(workers=workers, cache_size=cache_size)
+    server = await service.start(host, port, path)
+    print(f"serving on {path or f'{host}:{port}'}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--path", default=None, help="unix socket to listen on instead of tcp")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cache", type=int, default=256, help="number of Dists to keep")
+    args = parser.parse_args()
+
+    asyncio.run(_serve(args.host, args.port, args.path, args.workers, args.cache))
@@ -0,0 +1,202 @@
+"""
+Sharded runs, for simulating one definition on several hosts.
+
+    python shards.py run defs/atts1.json --out parts/ --n 1e9 --shards 64 --shard 0 1 2 3 --seed 7
+    python shards.py merge parts/ --out results/atts1.json
+
+A run is identified by a run id, by default a hash of the definition, n,
+the number of shards and the seed, so nodes started with the same
+arguments agree on it without coordinating. Shard i rolls its share of n
+from a generator seeded by SeedSequence(seed, spawn_key=(i,)) and writes
+its integer counts to a partial file in the output directory.
+
+Merging adds the integer counts of any set of partial files of one run,
+so the result is exact and the same whatever the order the files are
+merged in, and merging again gives the same Dist. Partial files of
+another run, or two files of the same shard, are rejected.
+"""
+import argparse
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import simplejson as json
+
+from classes import RollDef, Dist, Workspace
+from distat import input_files
+from serializer import Serializer
+from util import counts, accumulate_counts, bound_generator
+
+
+# rolls drawn at once by a shard, each shard reuses one workspace of this size
+CHUNK = 2 ** 18
+
+
+def run_id(definition: str, n: int, shards: int, seed: int) -> str:
+    """ identifies a run by the serialized definition and the arguments every shard shares """
+    canonical = json.dumps([json.loads(definition), int(n), int(shards), int(seed)], sort_keys=True)
+    return hashlib.sha1(canonical.encode()).hexdigest()[:16]
+
+
+def shard_sizes(n: int, shards: int) -> List[int]:
+    """ rolls of each shard, the remainder is spread over the first shards """
+    return [n // shards + (i < n % shards) for i in range(shards)]
+
+
+def shard_counts(rolldef: RollDef,
+                 n: int,
+                 shards: int,
+                 index: int,
+                 seed: int,
+                 chunk: int = None) -> Tuple[np.array, np.array, int]:
+    """ integer counts, bins and number of rolls of one shard of a run """
+    if chunk is None:
+        chunk = CHUNK
+
+    size = shard_sizes(int(n), shards)[index]
+    gen = np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=(index,))))
+
+    # the caller's workspace, if any, is bound again afterwards
+    previous = rolldef._workspace
+    acc = None
+    rolldef.bind(Workspace(min(chunk, max(size, 1))))
+    try:
+        with bound_generator(gen):
+            for start in range(0, size, chunk):
+                acc = accumulate_counts(acc, counts(rolldef(min(chunk, size - start))))
+    finally:
+        rolldef.bind(previous)
+
+    if acc is None:
+        return np.zeros(0, dtype=np.int64), np.arange(1), size
+    return acc[0], acc[1], size
+
+
+def partial_path(out: Path, name: str, index: int, shards: int) -> Path:
+    return Path(out) / f"{name}.shard-{index}-of-{shards}.json"
+
+
+def run_shards(definition: Union[str, Path],
+               out: Union[str, Path],
+               n: Union[int, float],
+               shards: int,
+               indices: List[int],
+               seed: int,
+               run: str = None,
+               chunk: int = None) -> List[Path]:
+    """
+    Rolls the given shards of a definition file and writes one partial
+    counts file per shard into 'out', returns their paths.
+    """
+    definition = Path(definition)
+    n = int(n)
+    rolldef = Serializer().load(definition)
+    if isinstance(rolldef, Dist):
+        rolldef = rolldef.rolldef
+    if not isinstance(rolldef, RollDef):
+        raise ValueError(f"{definition} does not hold a single RollDef")
+
+    serialized = Serializer.dump(rolldef)
+    if run is None:
+        run = run_id(serialized, n, shards, seed)
+
+    out = Path(out)
+    out.mkdir(parents=True, exist_ok=True)
+
+    written = []
+    for index in indices:
+        if not 0 <= index < shards:
+            raise ValueError(f"shard {index} is not one of {shards} shards")
+
+        c, b, size = shard_counts(rolldef, n, shards, index, seed, chunk)
+        partial = {"run": run, "shard": index, "shards": shards, "n": size, "total": n,
+                   "seed": seed, "counts": c.tolist(), "bins": b.tolist(),
+                   "definition": json.loads(serialized)}
+
+        # written under a temporary name and renamed, so a merge never reads half a file
+        path = partial_path(out, definition.stem, index, shards)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(partial, f)
+        os.replace(tmp, path)
+        written.append(path)
+
+    return written
+
+
+def load_partial(path: Union[str, Path]) -> Dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def merge(paths: List[Union[str, Path]], complete: bool = False) -> Dist:
+    """
+    Merges partial counts files, or directories of them, of a single run
+    into a Dist. If complete is True every shard of the run is required.
+    """
+    files = sorted(set([p.resolve() for p in input_files([Path(p) for p in paths])]))
+    partials = [load_partial(p) for p in files]
+    if not partials:
+        raise ValueError("no partial files to merge")
+
+    runs = set([p["run"] for p in partials])
+    if len(runs) > 1:
+        raise ValueError(f"partial files of different runs: {sorted(runs)}")
+
+    seen = {}
+    for path, p in zip(files, partials):
+        if p["shard"] in seen:
+            raise ValueError(f"shard {p['shard']} is in both {seen[p['shard']]} and {path}")
+        seen[p["shard"]] = path
+
+    shards = partials[0]["shards"]
+    missing = sorted(set(range(shards)) - set(seen))
+    if complete and missing:
+        raise ValueError(f"run {partials[0]['run']} is missing shards {missing}")
+
+    acc = None
+    for p in sorted(partials, key=lambda p: p["shard"]):
+        added = np.array(p["counts"], dtype=np.int64), np.array(p["bins"], dtype=np.int64)
+        acc = accumulate_counts(acc, added)
+    if acc is None:
+        raise ValueError("no rolls in partial files")
+
+    rolldef = Serializer().load(json.dumps(partials[0]["definition"]))
+    return Dist.from_counts(*acc, rolldef)
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(prog="shards", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="roll shards of a definition into partial files")
+    run_parser.add_argument("definition", type=Path, help="json file of a serialized RollDef")
+    run_parser.add_argument("--out", "-o", type=Path, required=True,
+                            help="directory to write partial files to, may be shared by all nodes")
+    run_parser.add_argument("--n", type=float, required=True, help="total number of rolls of the run")
+    run_parser.add_argument("--shards", type=int, required=True, help="number of shards of the run")
+    run_parser.add_argument("--shard", type=int, nargs="+", required=True, help="shards to roll on this node")
+    run_parser.add_argument("--seed", type=int, required=True)
+    run_parser.add_argument("--run", default=None, help="run id, defaults to a hash of the arguments")
+
+    merge_parser = commands.add_parser("merge", help="merge partial files into a Dist")
+    merge_parser.add_argument("paths", nargs="+", type=Path, help="partial files or directories of them")
+    merge_parser.add_argument("--out", "-o", type=Path, required=True, help="json file to write the Dist to")
+    merge_parser.add_argument("--complete", action="store_true", help="fail if any shard is missing")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        for path in run_shards(args.definition, args.out, args.n, args.shards, args.shard,
+                               args.seed, run=args.run):
+            print(f"wrote {path}")
+    else:
+        d = merge(args.paths, complete=args.complete)
+        Serializer.dump(d, args.out)
+        print(f"merged {d.n} rolls into {args.out}, mean {d.mean:.4f}")
+
+
+if __name__ == "__main__":
+    main()
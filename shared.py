@@ -0,0 +1,130 @@
+"""
+Evaluates several related rolldefs together, simulating each structurally
+identical subtree once per batch and feeding its rolls to every definition
+that contains it.
+
+Subtrees are matched by their structure alone, so a definition nested in
+another, or a subtree at any depth, is shared. Each cached subtree records
+the cached subtrees its rolls were built from, and a definition never uses
+two cached subtrees that overlap: the four dice of '4 * D(6)' are still
+independent of each other, and no subtree can get rolls that another part
+of the same definition was built from. Each definition's distribution is
+unaffected, the definitions are just no longer independent of one another.
+"""
+from typing import Dict, List, Tuple, Union
+import numpy as np
+
+from classes import RollDef, Dist
+from util import counts, accumulate_counts
+
+
+# attributes that only describe a rolldef and do not change its rolls
+DESCRIPTIVE_ATTRIBUTES = ("name", "desc", "verbose")
+
+
+def structural_key(obj: object, memo: Dict = None):
+    """
+    A hashable key that is equal for structurally identical definitions,
+    regardless of names, descriptions and object identity.
+    """
+    if memo is None:
+        memo = {}
+    if id(obj) in memo:
+        return memo[id(obj)][1]
+
+    if isinstance(obj, list) or isinstance(obj, tuple):
+        key = tuple([structural_key(o, memo) for o in obj])
+    elif isinstance(obj, np.ndarray):
+        key = (obj.dtype.str, obj.shape, obj.tobytes())
+    elif hasattr(obj, "__dict__"):
+        key = (obj.__class__.__name__,) + tuple(
+            [(k, structural_key(v, memo)) for k, v in sorted(obj.__dict__.items())
+             if not k.startswith("_") and k not in DESCRIPTIVE_ATTRIBUTES])
+    elif isinstance(obj, slice):
+        key = ("slice", obj.start, obj.stop, obj.step)
+    else:
+        key = obj
+
+    # keep the object alive so its id is not reused while memoized
+    memo[id(obj)] = (obj, key)
+    return key
+
+
+class SharedEvaluator(object):
+    """
+    Evaluates rolldefs while caching the rolls of every subtree, one batch
+    at a time. Call 'clear' between batches.
+    """
+
+    def __init__(self):
+        self._cache = {}
+        self._keys = {}
+        self._ids = {}
+        self._interned = {}
+
+    def clear(self):
+        self._cache = {}
+
+    def __call__(self, rolldef: RollDef, n: int) -> np.array:
+        """ rolls the definition 'n' times, reusing cached subtrees """
+        return self._eval(rolldef, int(n), set())
+
+    def _key(self, source) -> int:
+        """ the interned structure of a subtree """
+        if id(source) not in self._ids:
+            interned = self._interned.setdefault(structural_key(source, self._keys), len(self._interned))
+            self._ids[id(source)] = (source, interned)
+
+        return self._ids[id(source)][1]
+
+    def _eval(self, source, n: int, used: set) -> np.array:
+        """
+        rolls a subtree, 'used' holds the cache entries the definition has
+        used so far, including every entry the rolls of those were built from
+        """
+        key = self._key(source)
+        entries = self._cache.setdefault(key, [])
+
+        for rolls, built in entries:
+            if used.isdisjoint(built):
+                used |= built
+                return rolls.copy()
+
+        before = set(used)
+        if isinstance(source, list):
+            result = np.column_stack([self._eval(s, n, used) for s in source])
+        elif isinstance(source, RollDef):
+            result = source._apply(self._eval(source.source, n, used))
+        else:
+            result = source(n)
+
+        # actions modify rolls in place, so consumers only ever get copies
+        built = frozenset(used - before) | {(key, len(entries))}
+        entries.append((result, built))
+        used |= built
+        return result.copy()
+
+
+def shared_dists(rolldefs: List[RollDef],
+                 n: Union[int, float] = None,
+                 batch: Union[int, float] = None) -> List[Dist]:
+    """
+    Computes a Dist of 'n' rolls for each rolldef, simulating subtrees shared
+    between the rolldefs only once per batch of rolls.
+    """
+    if n is None:
+        n = 1e6
+    if batch is None:
+        batch = 2 ** 18
+
+    evaluator = SharedEvaluator()
+    hists = [None] * len(rolldefs)
+
+    for start in range(0, int(n), int(batch)):
+        size = min(int(batch), int(n) - start)
+        evaluator.clear()
+
+        for i, rd in enumerate(rolldefs):
+            hists[i] = accumulate_counts(hists[i], counts(evaluator(rd, size)))
+
+    return [Dist.from_counts(c, b, rd) for (c, b), rd in zip(hists, rolldefs)]
@@ -0,0 +1,259 @@
+"""
+Optimal reroll policies, found by backward induction over the distribution
+of a stat instead of simulating a sweep of ReRoll thresholds.
+
+With j rerolls left a roll x is kept if its utility u(x) is at least the
+expected utility V(j - 1) of rerolling, so
+
+    V(0) = E[u(X)]
+    V(j) = E[max(u(X), V(j - 1))]
+
+The utility is the roll itself to maximize the mean, or for example
+at_least(15) to maximize P(X >= 15). A budget of rerolls shared by several
+stats rolled one after another is solved the same way over the number of
+stats left s and rerolls left b, A(0, b) = 0, A(s, 0) = s * E[u(X)] and
+
+    A(s, b) = E[max(u(X) + A(s - 1, b), A(s, b - 1))]
+
+    policy = optimal_rerolls(atts2, rerolls=1)
+    policy.value, policy.rolldef, policy.dist
+
+The distribution of the total follows the budget policy forward over the
+states (s, b), each stat ending with b or fewer rerolls left.
+
+    budget = optimal_budget(atts2, stats=6, rerolls=3)
+    budget.value, budget.dist, budget.stat_dists
+"""
+from typing import Callable, List, Tuple, Union
+import numpy as np
+
+from classes import RollDef, Dist, ReRoll, EqualTo, LessThan
+from exact import exact_or_sampled, dist_from_pmf
+
+
+Utility = Callable[[np.array], np.array]
+
+
+def at_least(k: int) -> Utility:
+    """ utility of maximizing the probability of a roll of at least k """
+    def utility(x: np.array) -> np.array:
+        return (x >= k).astype(np.float64)
+    return utility
+
+
+def _mean(x: np.array) -> np.array:
+    return x.astype(np.float64)
+
+
+def inner_pmf(inner: Union[RollDef, Dist], n: Union[int, float] = None) -> Tuple[np.array, np.array, Dist]:
+    """
+    the consecutive values of a stat, their probabilities and its Dist. A
+    RollDef is evaluated exactly where possible and sampled otherwise.
+    """
+    d = inner
+    if isinstance(inner, RollDef):
+        d = exact_or_sampled(inner, n)
+    return d.bins[:-1], d.values, d
+
+
+def _selector(x: np.array, p: np.array, rerolled: np.array):
+    """ LessThan if the possible rerolled values are all those below a value, else EqualTo """
+    possible = p > 0
+    rerolled = rerolled & possible
+    kept = x[possible & ~rerolled]
+    if len(kept) and np.array_equal(rerolled[possible], x[possible] < kept[0]):
+        return LessThan(int(kept[0]))
+    return EqualTo([int(v) for v in x[rerolled]])
+
+
+def _rerolled(p: np.array, pmf: np.array, rerolled: np.array) -> np.array:
+    """ the pmf after rerolling the outcomes in 'rerolled' once """
+    return np.where(rerolled, 0.0, pmf) + np.sum(pmf[rerolled]) * p
+
+
+class Policy(object):
+    """ an optimal policy for rerolling a single stat """
+
+    def __init__(self,
+                 inner: Dist,
+                 rerolled: List[np.array],
+                 continuation: np.array,
+                 rolldef: RollDef,
+                 dist: Dist):
+        """
+        :param inner: Dist of the stat before any rerolls
+        :param rerolled: boolean arrays over inner.bins[:-1] of the values rerolled
+                         by each ReRoll, in the order they are applied
+        :param continuation: the expected utility V(j) with j rerolls left
+        :param rolldef: the inner rolldef with the policy's ReRoll ops
+        :param dist: distribution of the stat following the policy
+        """
+        self.inner = inner
+        self.rerolled = rerolled
+        self.continuation = continuation
+        self.rolldef = rolldef
+        self.dist = dist
+
+    @property
+    def value(self) -> float:
+        """ expected utility following the policy """
+        return float(self.continuation[-1])
+
+    def __repr__(self):
+        return f"Policy({len(self.rerolled)} rerolls, value {self.value:.4f})"
+
+
+def optimal_rerolls(inner: Union[RollDef, Dist],
+                    rerolls: int = 1,
+                    utility: Utility = None,
+                    n: Union[int, float] = None) -> Policy:
+    """
+    Solves for the rerolls of a stat that maximize its expected utility.
+
+    :param inner: the stat, a RollDef or its Dist
+    :param rerolls: number of times the stat may be rerolled
+    :param utility: utility of each value of the stat, the value itself by default
+    :param n: rolls to sample the inner rolldef with if it has no exact method
+    """
+    if utility is None:
+        utility = _mean
+
+    x, p, d = inner_pmf(inner, n)
+    u = utility(x)
+
+    continuation = [float(np.sum(p * u))]
+    for j in range(rerolls):
+        continuation.append(float(np.sum(p * np.maximum(u, continuation[-1]))))
+
+    # with j rerolls left, reroll whatever is worth less than rerolling, most rerolls left first
+    rerolled = [u < continuation[j - 1] for j in range(rerolls, 0, -1)]
+    rerolled = [r for r in rerolled if np.any(r & (p > 0))]
+
+    source = d.rolldef if isinstance(inner, Dist) else inner
+    rolldef = RollDef(source, [ReRoll(_selector(x, p, r)) for r in rerolled],
+                      name=f"{getattr(source, 'name', None)}, {rerolls} optimal rerolls")
+
+    pmf = p
+    for r in rerolled:
+        pmf = _rerolled(p, pmf, r)
+    dist = dist_from_pmf(pmf, int(x[0]), rolldef)
+    dist.exact, dist.n = d.exact, d.n
+
+    return Policy(d, rerolled, np.array(continuation), rolldef, dist)
+
+
+def _budget_outcomes(p: np.array, u: np.array, table: np.array, stats: int) -> np.array:
+    """
+    P(value, b') of a stat rolled with 'stats' stats and b rerolls left, that
+    ends with b' rerolls left, as an array indexed [b, b', value]
+    """
+    rerolls = table.shape[1] - 1
+    outcomes = np.zeros((rerolls + 1, rerolls + 1, len(p)))
+    outcomes[0, 0] = p
+    for b in range(1, rerolls + 1):
+        rerolled = u + table[stats - 1, b] < table[stats, b - 1]
+        outcomes[b, b] = np.where(rerolled, 0.0, p)
+        outcomes[b] += np.sum(p[rerolled]) * outcomes[b - 1]
+    return outcomes
+
+
+def _budget_pmfs(p: np.array, u: np.array, table: np.array) -> Tuple[np.array, List[np.array]]:
+    """
+    the pmf of the total of all the stats following the policy, starting at
+    stats * the lowest value, and the pmf of each stat in the order rolled
+    """
+    stats, rerolls = table.shape[0] - 1, table.shape[1] - 1
+
+    # P(total, b) of the stats rolled so far with b rerolls left
+    state = np.zeros((rerolls + 1, 1))
+    state[rerolls, 0] = 1.0
+    stat_pmfs = []
+    for s in range(stats, 0, -1):
+        outcomes = _budget_outcomes(p, u, table, s)
+        left = np.sum(state, axis=1)
+        stat_pmfs.append(np.tensordot(left, outcomes.sum(axis=1), axes=1))
+
+        added = np.zeros((rerolls + 1, state.shape[1] + len(p) - 1))
+        for b in np.flatnonzero(left):
+            for after in range(b + 1):
+                added[after] += np.convolve(state[b], outcomes[b, after])
+        state = added
+
+    return np.sum(state, axis=0), stat_pmfs
+
+
+class BudgetPolicy(object):
+    """ an optimal policy for a budget of rerolls shared by several stats """
+
+    def __init__(self,
+                 inner: Dist,
+                 utility: np.array,
+                 table: np.array,
+                 dist: Dist,
+                 stat_dists: List[Dist]):
+        """
+        :param inner: Dist of each stat before any rerolls
+        :param utility: utility of each value in inner.bins[:-1]
+        :param table: the expected total utility A(s, b) with s stats and b rerolls left
+        :param dist: distribution of the total of the stats following the policy
+        :param stat_dists: distribution of each stat following the policy, in the order rolled
+        """
+        self.inner = inner
+        self.utility = utility
+        self.table = table
+        self.dist = dist
+        self.stat_dists = stat_dists
+
+    @property
+    def value(self) -> float:
+        """ expected total utility of all the stats following the policy """
+        return float(self.table[-1, -1])
+
+    def rerolled(self, stats: int, rerolls: int) -> np.array:
+        """ the values rerolled with 'stats' stats, including this one, and 'rerolls' rerolls left """
+        x = self.inner.bins[:-1]
+        if rerolls == 0:
+            return x[:0]
+        keep = self.utility + self.table[stats - 1, rerolls]
+        return x[(keep < self.table[stats, rerolls - 1]) & (self.inner.values > 0)]
+
+    def reroll(self, x: np.array, stats: np.array, rerolls: np.array) -> np.array:
+        """ True where a roll x should be rerolled, vectorized over rolls """
+        idx = np.asarray(x) - int(self.inner.bins[0])
+        keep = self.utility[idx] + self.table[stats - 1, rerolls]
+        return (rerolls > 0) & (keep < self.table[stats, np.maximum(rerolls - 1, 0)])
+
+    def __repr__(self):
+        s, b = self.table.shape
+        return f"BudgetPolicy({s - 1} stats, {b - 1} rerolls, value {self.value:.4f})"
+
+
+def optimal_budget(inner: Union[RollDef, Dist],
+                   stats: int = 6,
+                   rerolls: int = 1,
+                   utility: Utility = None,
+                   n: Union[int, float] = None) -> BudgetPolicy:
+    """
+    Solves for the rerolls that maximize the expected total utility of
+    'stats' stats rolled one after another, sharing 'rerolls' rerolls.
+    Arguments are as optimal_rerolls.
+    """
+    if utility is None:
+        utility = _mean
+
+    x, p, d = inner_pmf(inner, n)
+    u = utility(x)
+
+    table = np.zeros((stats + 1, rerolls + 1))
+    table[:, 0] = np.arange(stats + 1) * np.sum(p * u)
+    for s in range(1, stats + 1):
+        for b in range(1, rerolls + 1):
+            table[s, b] = np.sum(p * np.maximum(u + table[s - 1, b], table[s, b - 1]))
+
+    total, stat_pmfs = _budget_pmfs(p, u, table)
+    dists = [dist_from_pmf(total, stats * int(x[0]), None)] + \
+            [dist_from_pmf(pmf, int(x[0]), None) for pmf in stat_pmfs]
+    for dist in dists:
+        dist.exact, dist.n = d.exact, d.n
+
+    return BudgetPolicy(d, u, table, dists[0], dists[1:])
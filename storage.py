@@ -0,0 +1,118 @@
+"""
+Persists the raw source rolls of a rolldef to a memory mapped .npy file so
+that different filters and aggregators can be run over the same rolls
+later, chunk by chunk, without simulating the source again or loading the
+whole file into memory.
+
+    store = persist(atts3, Path("4d6.npy"), n=1e9)
+    highest_3 = store.dist(Sum(Highest(3)))
+    highest_2 = store.dist(Sum(Highest(2)))
+"""
+from pathlib import Path
+from typing import Iterator, List, Union
+import numpy as np
+
+from classes import RollDef, Dist, Operation
+from serializer import Serializer
+from util import counts, accumulate_counts
+
+
+# rolls per chunk, each chunk of a pool of k dice holds k * 8 bytes per roll
+DEFAULT_CHUNK = 2 ** 20
+
+
+def _source_path(path: Path) -> Path:
+    """ the json file the source definition is kept in, next to the rolls """
+    return path.with_suffix(".source.json")
+
+
+class SampleStore(object):
+    """ raw source rolls kept on disk, along with the source that drew them """
+
+    def __init__(self, path: Union[str, Path], source=None):
+        """
+        :param path: path to the .npy file of raw rolls
+        :param source: source the rolls were drawn from, read from the
+                       json file saved next to the rolls if not given
+        """
+        self.path = Path(path)
+        if source is None:
+            source = Serializer().load(_source_path(self.path))
+        self.source = source
+
+        self._rolls = np.load(self.path, mmap_mode="r")
+
+    def __len__(self):
+        return self._rolls.shape[0]
+
+    @property
+    def shape(self):
+        return self._rolls.shape
+
+    def chunks(self, chunk: int = None) -> Iterator[np.array]:
+        """ yields the rolls in memory chunks that are safe to modify """
+        if chunk is None:
+            chunk = DEFAULT_CHUNK
+
+        for start in range(0, len(self), int(chunk)):
+            yield np.array(self._rolls[start: start + int(chunk)], dtype=np.int64)
+
+    def rolldef(self, ops: Union[Operation, List[Operation]], name: str = None) -> RollDef:
+        """ a rolldef applying ops to the stored source """
+        return RollDef(self.source, ops, name=name)
+
+    def apply(self, ops: Union[Operation, List[Operation]], chunk: int = None) -> Iterator[np.array]:
+        """ yields the result of the ops over each chunk of stored rolls """
+        rd = self.rolldef(ops)
+        for rolls in self.chunks(chunk):
+            yield rd._apply(rolls)
+
+    def dist(self,
+             ops: Union[Operation, List[Operation]],
+             name: str = None,
+             chunk: int = None) -> Dist:
+        """ computes the Dist of the ops over all of the stored rolls """
+        rd = self.rolldef(ops, name=name)
+
+        acc = None
+        for rolls in self.chunks(chunk):
+            acc = accumulate_counts(acc, counts(rd._apply(rolls)))
+        if acc is None:
+            raise ValueError(f"no rolls in {self.path}")
+
+        return Dist.from_counts(*acc, rd)
+
+
+def persist(source, path: Union[str, Path], n: Union[int, float], chunk: int = None) -> SampleStore:
+    """
+    Draws 'n' raw rolls of a source into a .npy file chunk by chunk.
+    If a RollDef is given its source is drawn, and its ops are ignored.
+
+    :param source: Die, list of sources, or RollDef whose source rolls to keep
+    :param path: .npy file to write
+    :param n: number of rolls to draw
+    :param chunk: number of rolls drawn and written at once
+    """
+    if chunk is None:
+        chunk = DEFAULT_CHUNK
+    if isinstance(source, RollDef):
+        source = source.source
+
+    path = Path(path)
+    n = int(n)
+    drawer = RollDef(source, [])
+
+    first = drawer._sources(min(int(chunk), n))
+    rolls = np.lib.format.open_memmap(path, mode="w+", dtype=first.dtype,
+                                      shape=(n,) + first.shape[1:])
+    rolls[:len(first)] = first
+
+    for start in range(len(first), n, int(chunk)):
+        stop = min(start + int(chunk), n)
+        rolls[start: stop] = drawer._sources(stop - start)
+
+    rolls.flush()
+    del rolls
+
+    Serializer.dump(source, _source_path(path))
+    return SampleStore(path, source)
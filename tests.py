@@ -91,6 +91,466 @@ def test_serializer():
     histogram1(my_rolldef3(1e6))
 
 
+def test_count():
+    pool = RollDef(
+        10 * D(10),
+        Count(GreaterThan(4)),
+        name="successes in 10d10")
+
+    rolls = pool(1e5)
+    assert rolls.min() >= 0 and rolls.max() <= 10
+
+    from exact import exact_or_sampled
+    exact = exact_or_sampled(pool)
+    assert exact.exact
+    assert abs(exact.mean - 6.0) < 1e-9
+    assert abs(exact.mean - np.mean(rolls)) < 0.05
+
+    big = exact_or_sampled(RollDef(50 * D(10), Count(GreaterThan(4))))
+    assert abs(np.sum(big.values) - 1) < 1e-9
+    assert abs(big.mean - 30.0) < 1e-9
+
+
+def test_batch_runner(tmp_path):
+    import distat
+
+    s = Serializer()
+    defs = tmp_path / "defs"
+    defs.mkdir()
+    s.dump(atts3, defs / "atts3.json")
+    s.dump([adv, disadv], defs / "advantage.json")
+
+    out = tmp_path / "out"
+    distat.main([str(defs), "--out", str(out), "--n", "2e4", "--workers", "2",
+                 "--seed", "1", "--memory-budget", "64K"])
+    d = s.load(out / "atts3.json")
+    assert d.n == 2e4
+    assert abs(np.sum(d.values) - 1) < 1e-9
+
+    # resuming tops up the existing results
+    distat.main([str(defs), "--out", str(out), "--n", "5e4", "--workers", "1", "-q"])
+    adv_d, disadv_d = s.load(out / "advantage.json")
+    assert adv_d.n == 5e4 and disadv_d.n == 5e4
+    assert adv_d.mean > disadv_d.mean
+
+    # weighted Dists are scheduled too, and chunks leave the global random state alone
+    from sampling import Sampler
+    weighted = tmp_path / "weighted"
+    weighted.mkdir()
+    from util import bound_generator
+    with bound_generator(np.random.default_rng(0)):
+        s.dump(Dist.calc(atts3, 1e4, sampler=Sampler(tilt=2)), weighted / "tilted.json")
+    state = np.random.get_state()[1].copy()
+    distat.main([str(weighted), "--out", str(out), "--n", "3e4", "--workers", "1", "--seed", "2", "-q"])
+    assert np.array_equal(state, np.random.get_state()[1])
+    tilted = s.load(out / "tilted.json")
+    assert tilted.n == 3e4 and tilted.sampler is not None and abs(tilted.mean - 12.24) < 0.1
+
+
+def test_sample_store(tmp_path):
+    from storage import persist, SampleStore
+
+    path = tmp_path / "4d6.npy"
+    store = persist(atts3, path, n=1e5, chunk=3e4)
+    assert store.shape == (100000, 4)
+
+    # reopened from disk, with the source read back from its json
+    store = SampleStore(path)
+    highest_3 = store.dist(Sum(Highest(3)), chunk=3e4)
+    highest_2 = store.dist(Sum(Highest(2)), chunk=3e4)
+    assert highest_3.n == 1e5 and highest_2.n == 1e5
+    assert abs(highest_3.mean - 12.24) < 0.1
+    assert 2.5 < highest_3.mean - highest_2.mean < 3
+    assert sum([len(r) for r in store.apply(Sum(), chunk=3e4)]) == 1e5
+
+    import pytest
+    empty = persist(atts3, tmp_path / "empty.npy", n=0)
+    with pytest.raises(ValueError, match="no rolls"):
+        empty.dist(Sum())
+
+
+def test_shared_subtrees(monkeypatch):
+    from shared import structural_key, SharedEvaluator, shared_dists
+
+    # atts1 contains atts2 verbatim, apart from names
+    assert structural_key(atts1.source) == structural_key(atts2)
+    assert structural_key(atts3) != structural_key(atts4)
+
+    evaluator = SharedEvaluator()
+    rolls2 = evaluator(atts2, 1000)
+    rolls3 = evaluator(atts3, 1000)
+    assert len(rolls2) == 1000 and len(rolls3) == 1000
+
+    # identical dice within one definition are still independent
+    pool = RollDef(2 * D(6), Difference([Position(0), Position(1)]))
+    assert np.count_nonzero(evaluator(pool, 1000)) > 0
+
+    d1, d2, d3 = shared_dists([atts1, atts2, atts3], n=1e5, batch=3e4)
+    assert d1.n == d2.n == d3.n == 1e5
+    assert abs(d3.mean - 12.24) < 0.1
+    assert d1.mean > d2.mean > d3.mean
+
+    # a subtree shared with another definition does not share dice with the rest of its own
+    from exact import exact_dist
+    rr = RollDef(D(6), ReRoll(EqualTo(1)))
+    a = RollDef([rr, rr], Sum())
+    b = RollDef([D(6), rr], Difference([Position(0), Position(1)]))
+    _, shared_b = shared_dists([a, b], n=1e5)
+    exact_b = exact_dist(b)
+    assert abs(shared_b.prob_at_least(0) - shared_b.prob_at_least(1) - 1 / 6) < 0.01
+    assert np.allclose(shared_b.values, exact_b.values, atol=0.01)
+    assert np.array_equal(shared_b.bins, exact_b.bins)
+
+    # atts1 rolls atts2 and rerolls it, so sharing it saves atts2's dice
+    drawn = []
+    roll = Die.__call__
+    monkeypatch.setattr(Die, "__call__", lambda die, n=None, *args, **kwargs:
+                        drawn.append(int(n)) or roll(die, n, *args, **kwargs))
+    shared_dists([atts1, atts2], n=1e5)
+    shared = sum(drawn)
+    drawn.clear()
+    atts1.dist(1e5), atts2.dist(1e5)
+    assert shared < 0.7 * sum(drawn)
+
+
+def test_exact_enumeration():
+    from exact import exact_dist
+
+    assert abs(exact_dist(atts3).mean - 15869 / 1296) < 1e-9
+    assert abs(exact_dist(adv).mean - 13.825) < 1e-9
+
+    # nested rerolls, and order dependent filters enumerated as tuples
+    assert abs(exact_dist(atts1).mean - np.mean(atts1(1e5))) < 0.05
+    first_two = exact_dist(RollDef(3 * D(6), Sum(Position(0, 2))))
+    assert abs(first_two.mean - 7.0) < 1e-9
+
+    spread = exact_dist(RollDef(4 * D(6), Difference([Highest(1), Lowest(1)])))
+    assert spread.bins[0] == 0 and spread.bins[-2] == 5
+
+    assert exact_dist(RollDef(20 * D(20), Sum(Highest(3)))) is None
+    assert exact_dist(atts3, max_outcomes=100) is None
+
+
+def test_jit():
+    import pytest
+    jit = pytest.importorskip("jit")
+    if not jit.HAVE_NUMBA:
+        pytest.skip("numba is not installed")
+
+    assert jit.compile_rolldef(atts1) is not None
+    assert jit.compile_rolldef(RollDef(3 * D(6), Sum(Position(0)))) is None
+
+    d = jit.jit_dist(atts1, 2e5, seed=7)
+    assert np.array_equal(d.values, jit.jit_dist(atts1, 2e5, seed=7).values)
+    assert abs(d.mean - 14.2595) < 0.05
+
+    count = jit.jit_dist(RollDef(10 * D(10), Count(GreaterThan(4))), 2e5, seed=7)
+    assert abs(count.mean - 6.0) < 0.05
+
+
+def test_weighted_sampling(tmp_path):
+    from exact import exact_dist
+    from sampling import Sampler, tail_error, calc_tail
+
+    # P(sum >= 58) on 10d6 is about 1e-6, out of reach of 1e5 plain rolls
+    ten_d6 = RollDef(10 * D(6), Sum())
+    exact = exact_dist(ten_d6).prob_at_least(58)
+    d = calc_tail(ten_d6, 58, rel_error=0.05, sampler=Sampler(tilt=5), chunk=2e4)
+    assert d.n <= 1e5
+    assert abs(d.prob_at_least(58) - exact) / exact < 0.25
+    assert d.ess < d.n
+
+    stratified = Dist.calc(atts3, 1e5, sampler=Sampler(stratify=True))
+    assert abs(stratified.mean - 15869 / 1296) < 0.05
+    stratified.add_accuracy(1e5)
+    assert stratified.n == 2e5 and tail_error(stratified, 18) < 0.1
+
+    # small stratified chunks still draw every face, so no probability is lost
+    one_die = RollDef([D(6)], Sum())
+    tilted = Sampler(tilt=6, stratify=True)
+    assert abs(np.sum(Dist.calc(one_die, 20, sampler=tilted).values) - 1) < 1e-9
+    assert Dist.calc(one_die, 3, sampler=tilted).n == 3
+
+    s = Serializer()
+    s.dump(stratified, tmp_path / "stratified.json")
+    assert s.load(tmp_path / "stratified.json").sampler.stratify
+
+
+def test_service(monkeypatch):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    import service as service_module
+    from service import DistService, Client
+
+    computed = []
+    compute = service_module._compute
+    monkeypatch.setattr(service_module, "_compute", lambda *args: computed.append(args) or compute(*args))
+
+    async def run():
+        service = DistService(executor=ThreadPoolExecutor(2), cache_size=2)
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        clients = [await Client.connect(port=port) for _ in range(3)]
+
+        # identical concurrent requests share one simulation
+        results = await asyncio.gather(*[c.dist(atts3, n=1e4) for c in clients])
+        assert len(set([r["key"] for r in results])) == 1
+        assert len(computed) == 1
+
+        key = results[0]["key"]
+        assert abs(await clients[0].stat(key, "mean") - results[0]["mean"]) < 1e-9
+        assert await clients[1].stat(key, "percentile", 0) == 3
+        assert await clients[2].stat(key, "at_least", 3) > 0.999
+
+        exact = await clients[0].dist(adv, n=1e4, exact=True)
+        assert exact["exact"] and abs(exact["mean"] - 13.825) < 1e-9
+
+        # requests longer than asyncio's default 64 KiB line limit
+        many = RollDef([RollDef(D(6), ReRoll(EqualTo(1)), name=f"die {i}") for i in range(400)], Sum())
+        assert abs((await clients[1].dist(many, n=1e3))["mean"] - 400 * 47 / 12) < 20
+
+        for c in clients:
+            await c.close()
+        server.close()
+        await server.wait_closed()
+        service.close()
+
+    asyncio.run(run())
+
+
+def test_dashboard_render(tmp_path):
+    from exact import exact_dist
+    from viz import render_dashboards
+
+    dists = [exact_dist(rd) for rd in [atts1, atts2, atts3, adv]]
+    db = RollDefDashboard(dists)
+    assert list(db.get_x_range()) == [1, 21]
+
+    db.save(tmp_path / "batched.png")
+    RollDefDashboard(dists, batched=False).save(tmp_path / "lines.png")
+
+    s = Serializer()
+    s.dump(db, tmp_path / "dashboard.json")
+    paths = [tmp_path / "a.png", tmp_path / "b.png"]
+    render_dashboards([db, tmp_path / "dashboard.json"], paths, workers=2)
+    assert all([p.stat().st_size > 0 for p in paths])
+
+    # unbatched dashboards stay unbatched when rendered by the pool, and the caller keeps its backend
+    s.dump(RollDefDashboard(dists, batched=False), tmp_path / "lines.json")
+    backend = plt.get_backend()
+    plt.switch_backend("pdf")
+    try:
+        render_dashboards([RollDefDashboard(dists, batched=False), tmp_path / "lines.json"],
+                          [tmp_path / "c.png", tmp_path / "d.png"], workers=1)
+        assert plt.get_backend() == "pdf"
+    finally:
+        plt.switch_backend(backend)
+    lines = (tmp_path / "lines.png").read_bytes()
+    assert (tmp_path / "c.png").read_bytes() == lines == (tmp_path / "d.png").read_bytes()
+    assert lines != (tmp_path / "batched.png").read_bytes()
+
+
+def test_threaded():
+    from threaded import threaded_counts, threaded_dist
+
+    c1, b1 = threaded_counts(atts1, 1e5, threads=1, chunk=3e4, seed=5)
+    c4, b4 = threaded_counts(atts1, 1e5, threads=4, chunk=3e4, seed=5)
+    assert np.array_equal(c1, c4) and np.array_equal(b1, b4)
+    assert np.sum(c4) == 1e5
+
+    d = threaded_dist(atts3, 1e5, threads=2)
+    assert d.n == 1e5 and abs(d.mean - 12.24) < 0.05
+
+
+def test_workspace():
+    import tracemalloc
+
+    rd = RollDef(
+        RollDef(
+            4 * RollDef(D(6), ReRoll(EqualTo(1))),
+            Sum(Highest(3))),
+        ReRoll(LessThan(14)))
+    counted = RollDef(6 * D([0, 1, 1, 2]), Count([GreaterThan(1), EqualTo(0)]))
+    unbound = [np.mean(rd(1e5)), np.mean(counted(1e5))]
+
+    ws = Workspace(2 ** 16, seed=0)
+    rd.bind(ws)
+    counted.bind(ws)
+    rd(2 ** 16)
+    counted(2 ** 16)
+
+    # steady state calls reuse the buffers, only numpy's small casting buffers are allocated
+    tracemalloc.start()
+    rolls = rd(2 ** 16)
+    counts = counted(2 ** 16)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    assert peak < 2 ** 16 * 8 / 4
+    assert rolls.shape == (2 ** 16,) and abs(np.mean(rolls) - unbound[0]) < 0.05
+    assert abs(np.mean(counts) - unbound[1]) < 0.05 and abs(np.mean(counts) - 3) < 0.05
+
+    rd.bind(None)
+    counted.bind(None)
+    assert rd(10).base is None
+
+    # a binding holds in its own thread only, threads of a threaded run roll unbound
+    from threaded import threaded_dist
+    atts3.bind(Workspace(2 ** 14))
+    try:
+        d = threaded_dist(atts3, 4e5, threads=4, chunk=2 ** 14)
+        assert abs(d.mean - 12.24) < 0.03
+        assert atts3._workspace is not None
+    finally:
+        atts3.bind(None)
+
+    # ops written without an 'out' argument still work unbound
+    class Middle(Filter):
+        def __call__(self, arr):
+            return np.sort(arr)[:, 1:-1]
+
+    class Odd(Selector):
+        def __call__(self, arr):
+            return arr % 2 == 1
+
+    custom = [RollDef(4 * D(6), Sum(Middle())), RollDef(4 * D(6), Count(Odd())),
+              RollDef(D(6), ReRoll(Odd())), RollDef(4 * D(6), [Middle(), Sum()])]
+    means = [7.0, 2.0, 3.75, 7.0]
+    for rd, mean in zip(custom, means):
+        assert abs(np.mean(rd(1e5)) - mean) < 0.05
+
+    # a pool of a multi-column source binds as well as it rolls unbound
+    pool = RollDef([RollDef(3 * D(6), Highest(2)), D(6)], Sum())
+    unbound = np.mean(pool(1e5))
+    pool.bind(Workspace(2 ** 16))
+    rolls = pool(1e5)
+    pool.bind(None)
+    assert rolls.shape == (1e5,) and abs(np.mean(rolls) - unbound) < 0.05
+
+
+def test_serializer_dag():
+    s = Serializer()
+
+    dumped = s.dump(atts1)
+    assert len(dumped) < len(s.dump(atts1, format=1)) / 1.5
+    loaded = s.load(dumped)
+    inner = loaded.source.source
+    assert all([rd is inner[0] for rd in inner])
+    assert loaded.name == atts1.name and loaded.ops[0].selector.less_than == 14
+    assert abs(np.mean(loaded(1e5)) - 14.26) < 0.05
+
+    # the nested format still loads, to the same definition
+    assert s.dump(s.load(s.dump(atts1, format=1))) == dumped
+
+    # deep definitions are written and read without recursion
+    deep = D(6)
+    for _ in range(5000):
+        deep = RollDef(deep, ReRoll(LessThan(1)))
+    loaded = s.load(s.dump(deep))
+    depth = 0
+    while isinstance(loaded, RollDef):
+        loaded, depth = loaded.source, depth + 1
+    assert depth == 5000 and isinstance(loaded, D)
+
+
+def test_shards(tmp_path):
+    import shutil
+    import subprocess
+    import sys
+    import pytest
+    import shards
+
+    s = Serializer()
+    definition = tmp_path / "atts1.json"
+    s.dump(atts1, definition)
+    parts = tmp_path / "parts"
+
+    # three processes stand in for the nodes, sharing the parts directory
+    args = ["run", str(definition), "--out", str(parts), "--n", "3e4", "--shards", "4", "--seed", "3"]
+    nodes = [subprocess.Popen([sys.executable, "shards.py"] + args + ["--shard"] + shard,
+                              cwd=Path(__file__).parent, stdout=subprocess.DEVNULL)
+             for shard in [["0"], ["1"], ["2", "3"]]]
+    assert all([node.wait() == 0 for node in nodes])
+
+    d = shards.merge([parts], complete=True)
+    assert d.n == 30000 and abs(d.mean - 14.26) < 0.1
+
+    # merging is exact and idempotent, in any grouping of the files
+    files = sorted(parts.glob("*.json"))
+    again = shards.merge(files[::-1] + [files[0]])
+    assert np.array_equal(d.counts()[0], again.counts()[0]) and np.array_equal(d.bins, again.bins)
+
+    # a shard rolled again gives the same counts
+    c, b, n = shards.shard_counts(atts1, 3e4, 4, 2, seed=3)
+    assert n == 7500 and c.tolist() == shards.load_partial(files[2])["counts"]
+
+    # a pool of a multi-column source shards too, and the caller's workspace stays bound
+    pool = RollDef([RollDef(3 * D(6), Highest(2)), D(6)], Sum())
+    ws = Workspace(2 ** 10)
+    pool.bind(ws)
+    c, b, n = shards.shard_counts(pool, 3e4, 4, 0, seed=3)
+    assert n == 7500 and np.sum(c) == 7500 and pool._workspace is ws
+    pool.bind(None)
+
+    with pytest.raises(ValueError):
+        shards.merge(files[:2], complete=True)
+
+    shutil.copy(files[1], tmp_path / "copy.json")
+    with pytest.raises(ValueError):
+        shards.merge(files + [tmp_path / "copy.json"])
+
+    other = shards.run_shards(definition, tmp_path / "other", 3e4, 4, [0], seed=4)
+    with pytest.raises(ValueError):
+        shards.merge(files[1:] + other)
+
+    # fewer rolls than shards leaves every shard of this node empty
+    empty = shards.run_shards(definition, tmp_path / "empty", 2, 4, [2, 3], seed=3)
+    with pytest.raises(ValueError, match="no rolls"):
+        shards.merge(empty)
+
+
+def test_solver():
+    from solver import optimal_rerolls, optimal_budget, at_least
+    from exact import exact_dist
+
+    # one optimal reroll of the generous 4d6 is the very generous 4d6
+    policy = optimal_rerolls(atts2, rerolls=1)
+    assert policy.rolldef.ops[0].selector.less_than == 14
+    assert np.isclose(policy.value, exact_dist(atts1).mean)
+    assert np.isclose(policy.dist.mean, exact_dist(policy.rolldef).mean)
+
+    likely_15 = optimal_rerolls(atts2, rerolls=2, utility=at_least(15))
+    assert np.isclose(likely_15.value, likely_15.dist.prob_at_least(15))
+    assert likely_15.value > exact_dist(atts2).prob_at_least(15)
+
+    # a shared budget of one stat is the single stat policy
+    budget = optimal_budget(atts2, stats=6, rerolls=3)
+    assert np.allclose(budget.table[1], optimal_rerolls(atts2, rerolls=3).continuation)
+
+    # simulate six stats sharing three rerolls following the policy
+    d = exact_dist(atts2)
+    x, p = d.bins[:-1], d.values
+    trials = 20000
+    total = np.zeros(trials)
+    rerolls = np.full(trials, 3)
+    for stats in range(6, 0, -1):
+        stat = np.random.choice(x, trials, p=p)
+        for _ in range(3):
+            again = budget.reroll(stat, stats, rerolls)
+            stat[again] = np.random.choice(x, np.count_nonzero(again), p=p)
+            rerolls -= again
+        total += stat
+    assert abs(np.mean(total) - budget.value) < 0.15
+
+    # the exact distribution of the total matches the simulated one
+    assert np.isclose(budget.dist.mean, budget.value)
+    assert np.isclose(sum([s.mean for s in budget.stat_dists]), budget.value)
+    assert abs(np.mean(total >= 86) - budget.dist.prob_at_least(86)) < 0.02
+
+    likely_15 = optimal_budget(atts2, stats=6, rerolls=3, utility=at_least(15))
+    assert np.isclose(sum([s.prob_at_least(15) for s in likely_15.stat_dists]), likely_15.value)
+
+
 def viz_reroll_strat():
 
     rolldefs = [
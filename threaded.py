@@ -0,0 +1,71 @@
+"""
+Rolls a rolldef on a pool of threads within this process. The rolls are
+split into chunks, each chunk draws from its own generator seeded from
+one SeedSequence, and the chunks' histograms are merged as they finish.
+
+Numpy's random generators, sorting, sums and bincount release the GIL,
+so chunks run concurrently while sharing the rolldef objects, with no
+pickling or copies as with a process pool. For a given seed and chunk
+size the counts do not depend on the number of threads.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Tuple, Union
+import numpy as np
+
+from classes import RollDef, Dist
+from util import counts, accumulate_counts, bound_generator
+
+
+# largest chunk of rolls drawn at once by one thread
+MAX_CHUNK = 2 ** 18
+
+
+def _roll_chunk(rolldef: RollDef, n: int, seed: np.random.SeedSequence) -> Tuple[np.array, np.array]:
+    with bound_generator(np.random.Generator(np.random.PCG64(seed))):
+        return counts(rolldef(n))
+
+
+def threaded_counts(rolldef: RollDef,
+                    n: Union[int, float],
+                    threads: int = None,
+                    chunk: int = None,
+                    seed: int = None) -> Tuple[np.array, np.array]:
+    """
+    Integer counts and bins of 'n' rolls of a rolldef, rolled on a pool of threads.
+
+    :param rolldef: the rolldef to roll
+    :param n: number of rolls
+    :param threads: number of threads, defaults to the cpu count
+    :param chunk: rolls per chunk, defaults to spreading n over four chunks per thread
+    :param seed: seed for the generators of all chunks
+    """
+    n = int(n)
+    if threads is None:
+        threads = os.cpu_count()
+    if chunk is None:
+        chunk = min(max(-(-n // (threads * 4)), 1), MAX_CHUNK)
+
+    sizes = [min(chunk, n - start) for start in range(0, n, int(chunk))]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    acc = None
+    with ThreadPoolExecutor(threads) as pool:
+        futures = [pool.submit(_roll_chunk, rolldef, size, s) for size, s in zip(sizes, seeds)]
+        for future in as_completed(futures):
+            acc = accumulate_counts(acc, future.result())
+
+    return acc
+
+
+def threaded_dist(rolldef: RollDef,
+                  n: Union[int, float] = None,
+                  threads: int = None,
+                  chunk: int = None,
+                  seed: int = None) -> Dist:
+    """ a Dist of 'n' rolls of a rolldef, rolled on a pool of threads """
+    if n is None:
+        n = 1e6
+
+    c, b = threaded_counts(rolldef, n, threads=threads, chunk=chunk, seed=seed)
+    return Dist.from_counts(c, b, rolldef)
@@ -1,8 +1,49 @@
+import threading
+from contextlib import contextmanager
+from weakref import WeakKeyDictionary
 import numpy as np
 import pandas as pd
 from typing import Tuple
 
 
+_local = threading.local()
+
+
+def generator() -> np.random.Generator:
+    """ the random generator bound to this thread, None to use numpy's global state """
+    return getattr(_local, "generator", None)
+
+
+@contextmanager
+def bound_generator(gen: np.random.Generator):
+    """ draws all dice rolled by this thread from 'gen' within the context """
+    previous = generator()
+    _local.generator = gen
+    try:
+        yield gen
+    finally:
+        _local.generator = previous
+
+
+def _workspaces() -> WeakKeyDictionary:
+    if not hasattr(_local, "workspaces"):
+        _local.workspaces = WeakKeyDictionary()
+    return _local.workspaces
+
+
+def bound_workspace(obj):
+    """ the workspace bound to an object in this thread, or None """
+    return _workspaces().get(obj)
+
+
+def bind_workspace(obj, workspace):
+    """ binds a workspace to an object for this thread only, None unbinds """
+    if workspace is None:
+        _workspaces().pop(obj, None)
+    else:
+        _workspaces()[obj] = workspace
+
+
 def dist(rolls: np.array) -> Tuple[np.array, np.array]:
     """ Computes the distribution of a rolls result"""
     hist = np.histogram(
@@ -13,6 +54,53 @@ def dist(rolls: np.array) -> Tuple[np.array, np.array]:
     return hist
 
 
+def counts(rolls: np.array) -> Tuple[np.array, np.array]:
+    """ counts occurrences of each integer value in a rolls result """
+    rolls = np.asarray(rolls).ravel()
+    low = int(np.min(rolls))
+    counted = np.bincount(rolls - low)
+    return counted, np.arange(low, low + len(counted) + 1)
+
+
+def accumulate_counts(
+        acc: Tuple[np.array, np.array],
+        added: Tuple[np.array, np.array]) -> Tuple[np.array, np.array]:
+    """
+    Adds a (counts, bins) histogram into a running total, which starts as None.
+    Empty histograms are skipped.
+    """
+    if len(added[0]) == 0:
+        return acc
+    if acc is None:
+        return added
+    return combine_counts(acc[0], acc[1], added[0], added[1])
+
+
+def combine_counts(
+        c1: np.array,
+        b1: np.array,
+        c2: np.array,
+        b2: np.array) -> Tuple[np.array, np.array]:
+    """
+    Exactly combines two count histograms with unit width bins. Also used
+    for histograms of summed weights, which keep their float type.
+
+    :param c1: counts array from 1st histogram
+    :param b1: bins array from 1st histogram (has length c1 + 1)
+    :param c2: counts array from 2nd histogram
+    :param b2: bins array from 2nd histogram (has length c2 + 1)
+    :return:
+    """
+    low = int(min(b1[0], b2[0]))
+    high = int(max(b1[-1], b2[-1]))
+
+    c1, c2 = np.asarray(c1), np.asarray(c2)
+    combined = np.zeros(high - low, dtype=np.result_type(c1, c2))
+    combined[int(b1[0]) - low: int(b1[-1]) - low] += c1
+    combined[int(b2[0]) - low: int(b2[-1]) - low] += c2
+    return combined, np.arange(low, high + 1)
+
+
 def cumulative_dist(rolls: np.array) -> Tuple[np.array, np.array]:
     """ accumulates the distribution """
     values, bins = dist(rolls)
@@ -68,6 +156,12 @@ def median_from_dist(values: np.array, bins: np.array):
     return bins[median_id]
 
 
+def percentile_from_dist(values: np.array, bins: np.array, q: float):
+    """ calculates the q-th percentile (0 to 100) from a distribution """
+    cvals = np.cumsum(values)
+    return bins[min(np.searchsorted(cvals, q / 100.0), len(bins) - 2)]
+
+
 def mean_from_dist(values: np.array, bins: np.array):
     """ calculates the mean from a distribution"""
     mean = np.sum(values * bins[:-1])
@@ -1,9 +1,21 @@
+import time
+from multiprocessing import get_context
+from pathlib import Path
 from typing import List, Union, Dict, Tuple
 import numpy as np
 import seaborn as sns
 from matplotlib import pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
 
 from classes import Dist, RollDef
+from shared import shared_dists
+
+
+# most distributions that are given a legend entry
+LEGEND_LIMIT = 20
 
 
 def histogram1(rolls, title=None, xmax=None, ymax=None):
@@ -42,11 +54,31 @@ def histogram1(rolls, title=None, xmax=None, ymax=None):
 
 class RollDefDashboard(object):
     """ A visualization that summarizes multiple rolldefs"""
-    def __init__(self, dists: List[Dist]):
+    def __init__(self, dists: List[Dist], batched: bool = True):
+        """
+        :param dists: the distributions to summarize
+        :param batched: draws all distributions of a panel as one artist,
+                        which keeps large sweeps fast to build and save
+        """
 
         self.dists = dists
-
-        self._fig = plt.figure(figsize=(20, 12))
+        self.batched = batched
+
+        # computed once, every panel uses them
+        self._colors = sns.hls_palette(len(self.dists))
+        self._x_ticks = self.get_x_ticks()
+        self._populated = False
+
+        # the figure is only made when the dashboard is drawn, loading many is cheap
+        self._fig = None
+
+    def _figure(self, headless: bool = False):
+        """ makes the figure and its axes, headless ones are not managed by pyplot """
+        if headless:
+            self._fig = Figure(figsize=(20, 12))
+            FigureCanvasAgg(self._fig)
+        else:
+            self._fig = plt.figure(figsize=(20, 12))
         self._grid = plt.GridSpec(12, 2, hspace=.8, wspace=0.5,
                                   top=0.95, bottom=0.05, left=0.05, right=0.95)
 
@@ -57,19 +89,42 @@ class RollDefDashboard(object):
         self._table_ax = self.__table_ax()
 
     @classmethod
-    def from_rolldefs(self, rolldefs: List[RollDef], n: Union[int, float] = None):
+    def from_rolldefs(self, rolldefs: List[RollDef], n: Union[int, float] = None, share: bool = True):
+        """
+        computes the dists of the rolldefs, if share is True subtrees that are
+        identical between rolldefs are simulated once and used by all of them
+        """
+        if share:
+            return RollDefDashboard(dists=shared_dists(rolldefs, n))
         return RollDefDashboard(dists=[rd.dist(n) for rd in rolldefs])
 
+    def populate(self, headless: bool = False):
+        """ draws every panel, only once """
+        if not self._populated:
+            self._figure(headless)
+            self._pop_hist_ax()
+            self._pop_mean_ax()
+            self._pop_median_ax()
+            self._pop_cum_ax()
+            self._populated = True
+
     def show(self):
-        self._pop_hist_ax()
-        self._pop_mean_ax()
-        self._pop_median_ax()
-        self._pop_cum_ax()
+        self.populate()
         plt.show()
 
+    def save(self, path: Union[str, Path], close: bool = True, headless: bool = False):
+        """
+        draws the dashboard to an image file. If headless the figure is drawn
+        with the Agg canvas, leaving pyplot and its backend alone.
+        """
+        self.populate(headless)
+        self._fig.savefig(path)
+        if close:
+            plt.close(self._fig)
+
     def __hist_ax(self):
         hist_ax = self._fig.add_subplot(self._grid[:4, 0])
-        hist_ax.set_xticks(self.get_x_ticks())
+        hist_ax.set_xticks(self._x_ticks)
         return hist_ax
 
     def __mean_ax(self):
@@ -84,93 +139,91 @@ class RollDefDashboard(object):
 
     def __cum_ax(self):
         cum_ax = self._fig.add_subplot(self._grid[8:, 0], sharex=self._hist_ax)
-        cum_ax.set_xticks(self.get_x_ticks())
+        cum_ax.set_xticks(self._x_ticks)
         return cum_ax
 
     def __table_ax(self):
         table_ax = self._fig.add_subplot(self._grid[:, 1])
         return table_ax
 
-    def _pop_hist_ax(self):
-
+    def _lines(self, ax, curves: List[Tuple[np.array, np.array]], linestyle: str = '-'):
+        """ plots one line per distribution, as a single collection if batched """
         names = self.names()
-        colors = self.color_dict().values()
-        dists = self.dists_dict().values()
-        ax = self._hist_ax
 
-        for n, c, d in zip(names, colors, dists):
-            ax.plot(
-                d.bins[:-1],
-                d.values,
-                color=c,
-                label=n,
-                linewidth=2)
+        if not self.batched:
+            for n, c, (x, y) in zip(names, self._colors, curves):
+                ax.plot(x, y, color=c, label=n, linewidth=2, linestyle=linestyle)
+            ax.legend()
+            return
+
+        segments = [np.column_stack((x, y)) for x, y in curves]
+        ax.add_collection(LineCollection(segments, colors=self._colors,
+                                         linewidths=2, linestyles=linestyle))
+        ax.autoscale_view()
+        self._legend(ax, names, linestyle)
+
+    def _vlines(self, ax, xs: List[float], linestyle: str = '-'):
+        """ one vertical line per distribution, as a single collection if batched """
+        if not self.batched:
+            for c, x in zip(self._colors, xs):
+                ax.axvline(x, color=c, linewidth=2, linestyle=linestyle)
+            ax.legend(xs)
+            return
+
+        ax.vlines(xs, 0, 1, colors=self._colors, linewidth=2, linestyles=linestyle,
+                  transform=ax.get_xaxis_transform())
+        self._legend(ax, xs, linestyle)
+
+    def _legend(self, ax, labels: List, linestyle: str):
+        """ legend of proxy lines, left out when there are too many to read """
+        if len(labels) <= LEGEND_LIMIT:
+            handles = [Line2D([], [], color=c, linewidth=2, linestyle=linestyle)
+                       for c in self._colors]
+            ax.legend(handles, labels)
+
+    def _pop_hist_ax(self):
+        ax = self._hist_ax
+        self._lines(ax, [(d.bins[:-1], d.values) for d in self.dists])
         ax.yaxis.grid()
         ax.set_ylim(0, None)
-        ax.legend()
         ax.set_ylabel('Distribution')
 
     def _pop_mean_ax(self):
-        names = self.names()
-        colors = self.color_dict().values()
-        means = self.means_dict().values()
         ax = self._mean_ax
-
-        for n, c, m in zip(names, colors, means):
-            ax.axvline(m, color=c, linewidth=2)
-
+        self._vlines(ax, [d.mean for d in self.dists])
         ax.set_ylabel("Mean")
-        ax.legend(means)
 
     def _pop_median_ax(self):
-        names = self.names()
-        colors = self.color_dict().values()
-        medians = self.medians_dict().values()
         ax = self._median_ax
-
-        for n, c, m in zip(names, colors, medians):
-            ax.axvline(m, color=c, linewidth=2, linestyle=':')
-
+        self._vlines(ax, [d.median for d in self.dists], linestyle=':')
         ax.set_ylabel("Median")
-        ax.legend(medians)
 
     def _pop_cum_ax(self):
-        names = self.names()
-        colors = self.color_dict().values()
-        dists = self.dists_dict().values()
         ax = self._cum_ax
-        for n, c, d in zip(names, colors, dists):
-            ax.plot(
-                d.bins[:-1],
-                np.cumsum(d.values),
-                color=c,
-                label=n,
-                linewidth=2)
+        self._lines(ax, [(d.bins[:-1], np.cumsum(d.values)) for d in self.dists])
         ax.yaxis.grid()
         ax.set_ylim(0, None)
-        ax.legend()
         ax.set_ylabel("Cumulative")
 
     def names(self):
         return [d.rolldef.name for d in self.dists]
-    
+
     def color_dict(self):
-        colors = sns.hls_palette(len(self.dists))
-        color_dict = {d.rolldef.name: c for d, c in zip(self.dists, colors)}
+        color_dict = {d.rolldef.name: c for d, c in zip(self.dists, self._colors)}
         return color_dict
 
     def get_x_ticks(self):
-        all = np.hstack([d.bins for d in self.dists])
+        all = np.concatenate([d.bins for d in self.dists])
         return np.unique(all)
 
     def get_x_range(self):
-        ticks = self.get_x_ticks()
-        return min(ticks), max(ticks)
+        return min(self._x_ticks), max(self._x_ticks)
 
     def add_accuracy(self, n: int):
         """ iteratively adds accuracy to all underlying distributions """
         for d in self.dists:
             d.add_accuracy(n)
+        self._x_ticks = self.get_x_ticks()
 
     def dists_dict(self) -> Dict[str, Tuple[np.array, np.array]]:
         """ returns a dict of the distributions """
@@ -185,4 +238,38 @@ class RollDefDashboard(object):
     def medians_dict(self) -> Dict[str, float]:
         """ returns dict of median values """
         median_dict = {d.rolldef.name: d.median for d in self.dists}
-        return median_dict
\ No newline at end of file
+        return median_dict
+
+
+def _render(job: Tuple[Union[List[Dist], Path], Path, bool]):
+    """ renders one dashboard to a file, without touching the process's pyplot backend """
+    dists, path, batched = job
+    if isinstance(dists, Path):
+        from serializer import Serializer  # serializer imports this module
+        loaded = Serializer().load(dists)
+        dists, batched = loaded.dists, loaded.batched
+
+    start = time.perf_counter()
+    RollDefDashboard(dists, batched=batched).save(path, headless=True)
+    return path, time.perf_counter() - start
+
+
+def render_dashboards(dashboards: List[Union[RollDefDashboard, Path]],
+                      paths: List[Union[str, Path]],
+                      workers: int = None) -> List[Path]:
+    """
+    Renders dashboards to image files headlessly, in parallel worker processes.
+
+    :param dashboards: dashboards, or paths to serialized dashboards
+    :param paths: image file to write for each dashboard
+    :param workers: number of worker processes, defaults to the cpu count
+    """
+    jobs = [(d, Path(p), None) if isinstance(d, Path) else (d.dists, Path(p), d.batched)
+            for d, p in zip(dashboards, paths)]
+
+    if workers == 1:
+        return [p for p, _ in map(_render, jobs)]
+
+    # fresh interpreters, forking a process that already holds figures can deadlock
+    with get_context("spawn").Pool(workers) as pool:
+        return [p for p, _ in pool.map(_render, jobs)]